@@ -0,0 +1,765 @@
+"""
+Código partilhado pelos dois front-ends (web_server.py e agent_user_pc.py):
+modelo e prompt, cache de respostas do LLM, tabelas de ferramentas e
+agendador, cache de schemas, roteamento de ferramentas, contexto com
+orçamento de tokens e histórico persistente.
+"""
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import importlib.util
+import importlib.metadata
+from collections import OrderedDict
+
+MODEL = "moonshotai/kimi-k2-instruct-0905"
+SYSTEM_PROMPT = """
+Você é um Agente DevOps Local e Agente de Automação de PC.
+Você tem acesso a ferramentas MCP para:
+- executar comandos no terminal
+- manipular arquivos (ler, escrever, listar)
+- controlar mouse e teclado
+- trabalhar com Git
+- capturar screenshots
+
+Use as ferramentas sempre que necessário.
+Explique o que está fazendo de forma clara.
+Seja cuidadoso com comandos destrutivos.
+Sempre confirme antes de executar operações importantes.
+"""
+
+# =========================
+# CACHE DE RESPOSTAS DO LLM
+# =========================
+# Cache de respostas (opt-in). off: desligado. on: memória (LRU) + disco.
+# record: chama sempre o LLM e grava. replay: só responde do que foi gravado,
+# sem rede (uma requisição sem gravação é um erro).
+LLM_CACHE = os.environ.get("LLM_CACHE", "off")
+LLM_CACHE_DIR = os.environ.get("LLM_CACHE_DIR", ".llm_cache")
+LLM_CACHE_MEMORY_BYTES = int(os.environ.get("LLM_CACHE_MEMORY_MB", "32")) * 1024 * 1024
+LLM_TEMPERATURE = 0.2
+LLM_MAX_TOKENS = 2048
+
+def llm_cache_key(messages, tools):
+    """Hash de tudo o que determina a resposta: modelo, parâmetros, mensagens e ferramentas"""
+    payload = json.dumps(
+        {"model": MODEL, "temperature": LLM_TEMPERATURE, "max_tokens": LLM_MAX_TOKENS,
+         "messages": messages, "tools": tools},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LLMCache:
+    """Respostas (conteúdo, tool_calls) por chave: LRU em memória limitado em bytes + um arquivo por chave"""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _remember(self, key, entry):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old["_size"]
+        entry["_size"] = len(entry["content"]) + sum(len(tc["arguments"]) + 64 for tc in entry["tool_calls"])
+        self.entries[key] = entry
+        self.size += entry["_size"]
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted["_size"]
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._remember(key, dict(entry))
+
+llm_cache = LLMCache(LLM_CACHE_DIR, LLM_CACHE_MEMORY_BYTES) if LLM_CACHE != "off" else None
+
+# =========================
+# FERRAMENTAS
+# =========================
+# Ferramentas de GUI (mouse, teclado, tela): têm estado, então cada sessão
+# fica presa a um worker e elas nunca executam em paralelo
+GUI_TOOLS = {
+    "screen_size", "mouse_position", "move_mouse", "click", "double_click",
+    "right_click", "type_text", "press_key", "hotkey", "screenshot", "capture_screen", "scroll",
+    "execute_actions"
+}
+
+# Ferramentas de uso interno (métricas), não oferecidas ao LLM
+INTERNAL_TOOLS = {"server_metrics"}
+
+# Prefixo das imagens gravadas em arquivo pelo servidor (MCP_OOB_DIR)
+OOB_MARKER = "[oob] "
+# Diretório das imagens fora de banda: só arquivos dentro dele são lidos (e apagados)
+OOB_DIR = os.environ.get("MCP_OOB_DIR")
+# Ferramentas que podem devolver imagens fora de banda
+OOB_TOOLS = {"capture_screen", "execute_actions"}
+
+def parse_oob(tool_name, text):
+    """
+    Interpreta uma referência [oob] devolvida por uma ferramenta de imagem.
+    Retorna (mime_type, tamanho, caminho) ou None quando o texto não é uma
+    referência válida para um arquivo em MCP_OOB_DIR (o texto fica como está).
+    """
+    if not OOB_DIR or tool_name not in OOB_TOOLS or not text or not text.startswith(OOB_MARKER):
+        return None
+    try:
+        mime_type, size, path = text[len(OOB_MARKER):].split(" ", 2)
+        size = int(size)
+    except ValueError:
+        return None
+    if not mime_type.startswith("image/"):
+        return None
+    path = os.path.realpath(path)
+    if os.path.dirname(path) != os.path.realpath(OOB_DIR):
+        return None
+    return mime_type, size, path
+
+# =========================
+# AGENDADOR DE TOOL CALLS
+# =========================
+# Ferramentas somente-leitura podem executar em paralelo entre si
+READ_ONLY_TOOLS = {
+    "pwd", "list_dir", "read_file", "read_bytes", "read_output", "git_status", "git_diff",
+    "git_log", "system_info", "cache_stats", "fetch_output", "walk_tree", "find_files",
+    "grep_files", "request_tools"
+}
+
+def classify_tool(tool_name):
+    """Classifica a ferramenta: 'read', 'gui' ou 'write'"""
+    if tool_name in READ_ONLY_TOOLS:
+        return "read"
+    if tool_name in GUI_TOOLS:
+        return "gui"
+    return "write"
+
+def schedule_tool_calls(tool_calls):
+    """
+    Divide as tool calls em lotes ordenados: leituras consecutivas formam um
+    lote paralelo; escritas e GUI executam sozinhas, servindo de barreira
+    """
+    batches = []
+    parallel = False
+    for tool_call in tool_calls:
+        is_read = classify_tool(tool_call.function.name) == "read"
+        if is_read and parallel:
+            batches[-1].append(tool_call)
+        else:
+            batches.append([tool_call])
+        parallel = is_read
+    return batches
+
+# =========================
+# CACHE DE SCHEMAS DE FERRAMENTAS
+# =========================
+# Os schemas no formato Groq ficam em disco, versionados pelo hash do
+# servidor MCP; web_server e agent_user_pc partilham a mesma pasta ("" desativa)
+TOOL_SCHEMA_CACHE_DIR = os.environ.get(
+    "TOOL_SCHEMA_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "mcp-devops")
+)
+MCP_SERVER_SCRIPT = "mcp_pc_devops_agent.py"
+# auto: ferramentas de GUI só com display (DISPLAY/WAYLAND_DISPLAY; sempre em Windows/macOS)
+AGENT_GUI_TOOLS = os.environ.get("AGENT_GUI_TOOLS", "auto")
+HAS_DISPLAY = sys.platform in ("win32", "darwin") or bool(
+    os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY")
+)
+
+def tool_schema_version(script=MCP_SERVER_SCRIPT):
+    """Hash do servidor e do que altera as ferramentas registradas (pyautogui, SDK MCP)"""
+    digest = hashlib.sha256()
+    try:
+        with open(script, "rb") as f:
+            digest.update(f.read())
+    except OSError:
+        return None
+    digest.update(f"pyautogui={importlib.util.find_spec('pyautogui') is not None}".encode())
+    try:
+        digest.update(f"mcp={importlib.metadata.version('mcp')}".encode())
+    except importlib.metadata.PackageNotFoundError:
+        pass
+    return digest.hexdigest()[:16]
+
+def _tool_schema_path(version):
+    return os.path.join(TOOL_SCHEMA_CACHE_DIR, f"tools-{version}.json")
+
+def load_tool_schemas(version):
+    if not TOOL_SCHEMA_CACHE_DIR or not version:
+        return None
+    try:
+        with open(_tool_schema_path(version), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_tool_schemas(version, tools):
+    if not TOOL_SCHEMA_CACHE_DIR or not version:
+        return
+    try:
+        os.makedirs(TOOL_SCHEMA_CACHE_DIR, exist_ok=True)
+        path = _tool_schema_path(version)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(tools, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"⚠️  Falha ao gravar o cache de ferramentas: {e}")
+
+def to_groq_tools(tools):
+    """Ferramentas MCP no formato de function calling (sem as internas)"""
+    return [
+        {
+            "type": "function",
+            "function": {
+                "name": tool.name,
+                "description": tool.description,
+                "parameters": tool.inputSchema
+            }
+        }
+        for tool in tools
+        if tool.name not in INTERNAL_TOOLS
+    ]
+
+def gui_tools_enabled():
+    if AGENT_GUI_TOOLS == "auto":
+        return HAS_DISPLAY
+    return AGENT_GUI_TOOLS == "on"
+
+def select_tools(tools):
+    """Remove as ferramentas inúteis nesta máquina (GUI sem display), reduzindo o pedido ao LLM"""
+    if gui_tools_enabled():
+        return tools
+    return [t for t in tools if t["function"]["name"] not in GUI_TOOLS]
+
+# =========================
+# CONTEXTO COM ORÇAMENTO DE TOKENS
+# =========================
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "24000"))
+TOOL_RESULT_INLINE_TOKENS = int(os.environ.get("TOOL_RESULT_INLINE_TOKENS", "2000"))
+MAX_STORED_OUTPUTS = 128
+CHARS_PER_TOKEN = 4
+
+# Ferramenta local (não MCP) para recuperar saídas guardadas fora do contexto
+FETCH_OUTPUT_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "fetch_output",
+        "description": "Recupera um trecho de uma saída de ferramenta guardada fora do contexto (ex: out-3)",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "ref": {"type": "string"},
+                "offset": {"type": "integer", "default": 0},
+                "length": {"type": "integer", "default": 8000}
+            },
+            "required": ["ref"]
+        }
+    }
+}
+
+def estimate_tokens(message):
+    """Estimativa barata de tokens de uma mensagem (~4 caracteres por token)"""
+    chars = len(message.get("content") or "")
+    for tc in message.get("tool_calls") or []:
+        chars += len(tc["function"]["name"]) + len(tc["function"]["arguments"])
+    return chars // CHARS_PER_TOKEN + 4
+
+# =========================
+# ROTEAMENTO DE FERRAMENTAS
+# =========================
+# Em vez de enviar todos os schemas em cada chamada ao LLM, cada turno
+# começa com o núcleo + os grupos sugeridos pela mensagem e pelas
+# ferramentas usadas recentemente; o modelo pede mais com request_tools
+TOOL_ROUTING = os.environ.get("TOOL_ROUTING", "on") == "on"
+ROUTING_HISTORY = 8
+
+TOOL_GROUPS = {
+    "files": {
+        "walk_tree", "find_files", "grep_files", "read_bytes", "write_file", "append_file",
+        "edit_file", "apply_patch", "write_files"
+    },
+    "shell": {"start_command", "read_output", "send_input", "cancel_command", "wait", "abort"},
+    "git": {"git_status", "git_diff", "git_log", "git_add", "git_commit", "git_push"},
+    "gui": GUI_TOOLS,
+    "system": {"system_info", "cache_stats"}
+}
+# Nunca ocultadas, mesmo que façam parte de um grupo inativo
+# (as ferramentas fora de qualquer grupo também são sempre oferecidas)
+CORE_TOOLS = {"pwd", "list_dir", "read_file", "run_command"}
+
+ROUTING_KEYWORDS = {
+    "files": re.compile(
+        r"arquiv|ficheir|\bfiles?\b|pasta|diret[oó]ri|folder|escrev|\bwrite|edit|patch|"
+        r"c[oó]digo|\bcode|grep|procur|busc|\bfind|search|conte[uú]do|cri[ae]r? (o |um )?arquivo|"
+        r"[\w-]+\.(py|js|ts|json|ya?ml|md|txt|html|css|sh|toml|cfg|ini|c|cpp|h|go|rs|java)\b|[\w.-]*/[\w.-]+"
+    ),
+    "shell": re.compile(
+        r"comando|command|execut|rod[ae]|\brun\b|instal|npm|pip|docker|build|compil|test|"
+        r"processo|process|terminal|shell|bash|\bmake\b|servi[cç]o|servidor|server|\bkill|"
+        r"\bpar(e|ar)\b|abort|esper|\bwait|\blogs?\b"
+    ),
+    "git": re.compile(r"\bgit\b|commit|branch|\bpush|\bpull|\bdiff|merge|reposit[oó]rio|\brepo\b|stage"),
+    "gui": re.compile(
+        r"tela|screen|captur|mouse|cliq|clic|click|digit|\btype\b|teclad|keyboard|tecla|\bkeys?\b|"
+        r"janela|window|navegador|browser|rol[ae]r|scroll|atalho|hotkey|cursor"
+    ),
+    "system": re.compile(r"sistema|system|\bcpu\b|mem[oó]ria|vers[aã]o|version|cache|\binfo|hardware"),
+}
+
+REQUEST_TOOLS_TOOL = {
+    "type": "function",
+    "function": {
+        "name": "request_tools",
+        "description": (
+            "Ativa mais ferramentas neste turno. Grupos: files (procurar/escrever/editar arquivos), "
+            "shell (processos em segundo plano, wait, abort), git, gui (mouse, teclado, tela), "
+            "system (informações do sistema) ou all"
+        ),
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "groups": {
+                    "type": "array",
+                    "items": {"type": "string", "enum": [*TOOL_GROUPS, "all"]}
+                }
+            },
+            "required": ["groups"]
+        }
+    }
+}
+
+def recent_tool_names(messages, limit=ROUTING_HISTORY):
+    """Nomes das últimas ferramentas chamadas no histórico"""
+    names = []
+    for message in reversed(messages):
+        for tc in reversed(message.get("tool_calls") or []):
+            names.append(tc["function"]["name"])
+            if len(names) >= limit:
+                return names
+    return names
+
+def route_groups(message, messages):
+    """Grupos sugeridos pelas palavras da mensagem e pelas ferramentas usadas recentemente"""
+    text = (message or "").lower()
+    groups = {group for group, pattern in ROUTING_KEYWORDS.items() if pattern.search(text)}
+    for name in recent_tool_names(messages):
+        groups.update(group for group, names in TOOL_GROUPS.items() if name in names)
+    return groups
+
+class ToolRouter:
+    """Ferramentas oferecidas ao LLM durante um turno, expansíveis a pedido do modelo"""
+
+    def __init__(self, tools, message="", messages=()):
+        self.tools = tools
+        names = {t["function"]["name"] for t in tools}
+        self.available = {group for group, members in TOOL_GROUPS.items() if members & names}
+        self.groups = route_groups(message, messages) & self.available if TOOL_ROUTING else set(self.available)
+        self.expansions = 0
+
+    def selected(self):
+        """Subconjunto atual, mais as ferramentas locais"""
+        hidden = set().union(*(TOOL_GROUPS[g] for g in self.available - self.groups)) - CORE_TOOLS
+        tools = [t for t in self.tools if t["function"]["name"] not in hidden]
+        tools.append(FETCH_OUTPUT_TOOL)
+        if hidden:
+            tools.append(REQUEST_TOOLS_TOOL)
+        return tools
+
+    def expand(self, groups):
+        """Executa request_tools: ativa os grupos pedidos até ao fim do turno"""
+        groups = set(groups or [])
+        requested = set(self.available) if "all" in groups else groups & self.available
+        added = requested - self.groups
+        self.groups |= requested
+        if not added:
+            return f"Nenhum grupo novo ativado (ativos: {', '.join(sorted(self.groups)) or 'núcleo'})"
+        self.expansions += 1
+        tools = sorted(set().union(*(TOOL_GROUPS[g] for g in added)))
+        return f"Ferramentas ativadas ({', '.join(sorted(added))}): {', '.join(tools)}"
+
+    def recover(self, error):
+        """O modelo chamou uma ferramenta fora do subconjunto: oferece todas e repete"""
+        if "not in request.tools" in str(error) and self.groups != self.available:
+            self.groups = set(self.available)
+            self.expansions += 1
+            return True
+        return False
+
+# =========================
+# HISTÓRICO PERSISTENTE (log append-only)
+# =========================
+# Cada mensagem da conversa vira um evento num SQLite (WAL); "" desativa.
+# Resultados de ferramentas guardam também o resumo que entrou no prompt,
+# para que retomar uma sessão não precise ler as saídas completas.
+CONVERSATION_DB = os.environ.get("CONVERSATION_DB", "conversations.db")
+HISTORY_PAGE_SIZE = 30
+HISTORY_PREVIEW_CHARS = 2000
+TAIL_READ_BATCH = 64
+
+class SQLiteFile:
+    """Arquivo SQLite em modo WAL com uma ligação por thread"""
+
+    def __init__(self, path, schema):
+        self.path = path
+        self._local = threading.local()
+        db = self._db()
+        db.executescript(schema)
+        db.commit()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+class ConversationLog(SQLiteFile):
+    """Eventos (mensagens) de cada sessão, só acrescentados, numerados por seq"""
+
+    def __init__(self, path):
+        super().__init__(path, """
+            CREATE TABLE IF NOT EXISTS events (
+                session_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                role TEXT NOT NULL,
+                data TEXT NOT NULL,
+                summary TEXT,
+                created REAL NOT NULL,
+                PRIMARY KEY (session_id, seq)
+            );
+        """)
+
+    def append(self, session_id, events):
+        """
+        events: lista de (seq, mensagem, resumo ou None). Se outra ligação à
+        mesma sessão já gravou esses seq, os eventos são renumerados a seguir
+        ao último, na mesma transação. Retorna o deslocamento aplicado.
+        """
+        db = self._db()
+        now = time.time()
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            last = db.execute("SELECT MAX(seq) FROM events WHERE session_id = ?", (session_id,)).fetchone()[0] or 0
+            offset = max(0, last + 1 - events[0][0])
+            db.executemany(
+                "INSERT INTO events (session_id, seq, role, data, summary, created) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, seq + offset, message["role"], json.dumps(message, ensure_ascii=False),
+                     json.dumps(summary, ensure_ascii=False) if summary else None, now)
+                    for seq, message, summary in events
+                ]
+            )
+        return offset
+
+    def get(self, session_id, seq):
+        row = self._db().execute(
+            "SELECT data FROM events WHERE session_id = ? AND seq = ?", (session_id, seq)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def last_seq(self, session_id):
+        row = self._db().execute("SELECT MAX(seq) FROM events WHERE session_id = ?", (session_id,)).fetchone()
+        return row[0] or 0
+
+    def _last_clear(self, session_id):
+        row = self._db().execute(
+            "SELECT MAX(seq) FROM events WHERE session_id = ? AND role = 'clear'", (session_id,)
+        ).fetchone()
+        return row[0] or 0
+
+    def tail(self, session_id, before=None):
+        """Itera (seq, mensagem no prompt, created) do fim até o último 'clear', em lotes"""
+        first = self._last_clear(session_id)
+        while True:
+            rows = self._db().execute(
+                "SELECT seq, COALESCE(summary, data), created FROM events "
+                "WHERE session_id = ? AND seq > ? AND seq < COALESCE(?, seq + 1) "
+                "ORDER BY seq DESC LIMIT ?",
+                (session_id, first, before, TAIL_READ_BATCH)
+            ).fetchall()
+            if not rows:
+                return
+            for seq, data, created in rows:
+                yield seq, json.loads(data), created
+            before = rows[-1][0]
+
+    def page(self, session_id, before=None, limit=HISTORY_PAGE_SIZE):
+        """Página de histórico para a interface: (itens do mais antigo ao mais novo, há mais?)"""
+        items = []
+        has_more = False
+        for seq, message, created in self.tail(session_id, before):
+            if len(items) == limit:
+                has_more = True
+                break
+            if message["role"] == "assistant" and not message.get("content"):
+                continue
+            if message["role"] not in ("user", "assistant", "tool"):
+                continue
+            items.append({
+                "seq": seq,
+                "role": message["role"],
+                "name": message.get("name"),
+                "content": (message.get("content") or "")[:HISTORY_PREVIEW_CHARS],
+                "created": created
+            })
+        return items[::-1], has_more
+
+class ConversationContext:
+    """
+    Histórico de mensagens com orçamento de tokens. Saídas grandes de
+    ferramentas ficam fora do prompt atrás de uma referência (fetch_output);
+    resultados antigos são compactados e, se preciso, turnos antigos descartados.
+    Com um ConversationLog, cada mensagem é gravada (flush) e as saídas
+    guardadas são lidas do log só quando pedidas.
+    """
+
+    def __init__(self, system_prompt, budget=CONTEXT_TOKEN_BUDGET, log=None, session_id=None):
+        self.system_prompt = system_prompt
+        self.budget = budget
+        self.log = log
+        self.session_id = session_id
+        self.pending = []
+        self.next_seq = 0
+        # (primeiro seq local, deslocamento no log): muda quando outra ligação
+        # à mesma sessão grava primeiro e os eventos são renumerados
+        self.seq_offsets = [(0, 0)]
+        self._flush_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.messages = [{"role": "system", "content": self.system_prompt}]
+        self.outputs = OrderedDict()
+        self.refs = {}
+        self.tool_seqs = {}
+        self.compacted = set()
+        self.raw_tokens = estimate_tokens(self.messages[0])
+        self._next_ref = 1
+
+    def clear(self):
+        self._reset()
+        self._record({"role": "clear"})
+
+    def _record(self, message, summary=None):
+        if self.log is None:
+            return None
+        self.next_seq += 1
+        self.pending.append((self.next_seq, message, summary))
+        return self.next_seq
+
+    def _log_seq(self, seq):
+        for first, offset in reversed(self.seq_offsets):
+            if seq >= first:
+                return seq + offset
+        return seq
+
+    def flush(self):
+        """Grava no log os eventos pendentes (mantidos se a gravação falhar)"""
+        if self.log is None:
+            return
+        with self._flush_lock:
+            if not self.pending:
+                return
+            count = len(self.pending)
+            batch = self.pending[:count]
+            offset = self.log.append(
+                self.session_id, [(self._log_seq(seq), message, summary) for seq, message, summary in batch]
+            )
+            if offset:
+                self.seq_offsets.append((batch[0][0], self.seq_offsets[-1][1] + offset))
+            del self.pending[:count]
+
+    def append(self, message):
+        self.messages.append(message)
+        self.raw_tokens += estimate_tokens(message)
+        self._record(message)
+
+    def store_output(self, text, seq=None):
+        if seq is not None and self.log is not None:
+            # O texto completo já está no log: a referência aponta para o evento
+            return f"out-{seq}"
+        ref = f"out-{self._next_ref}"
+        self._next_ref += 1
+        self.outputs[ref] = text
+        while len(self.outputs) > MAX_STORED_OUTPUTS:
+            self.outputs.popitem(last=False)
+        return ref
+
+    def _inline(self, tool_call_id, text, seq):
+        """Mensagem de ferramenta como entra no prompt (resumida se for grande)"""
+        message = {"role": "tool", "tool_call_id": tool_call_id, "content": text}
+        limit = TOOL_RESULT_INLINE_TOKENS * CHARS_PER_TOKEN
+        if len(text) > limit:
+            ref = self.store_output(text, seq)
+            self.refs[tool_call_id] = ref
+            message["content"] = (
+                f"{text[:limit // 2]}\n[... {len(text) - limit} caracteres omitidos ...]\n"
+                f"{text[-limit // 2:]}\n[saída completa ({len(text)} caracteres) em {ref}; use fetch_output]"
+            )
+        return message
+
+    def add_tool_result(self, tool_call_id, text, name=None):
+        """Adiciona o resultado; se for grande, só um resumo entra no prompt"""
+        full = {"role": "tool", "tool_call_id": tool_call_id, "content": text}
+        self.raw_tokens += estimate_tokens(full)
+        seq = None
+        if self.log is not None:
+            seq = self.next_seq + 1
+            self.tool_seqs[tool_call_id] = seq
+        message = self._inline(tool_call_id, text, seq)
+        self.messages.append(message)
+        if seq is not None:
+            summary = dict(message, name=name) if message["content"] is not text else None
+            self._record(dict(full, name=name), summary)
+
+    def _load_output(self, seq):
+        for pending_seq, message, _ in self.pending:
+            if pending_seq == seq:
+                return message.get("content")
+        message = self.log.get(self.session_id, self._log_seq(seq))
+        return message.get("content") if message else None
+
+    def fetch(self, ref, offset=0, length=8000):
+        text = self.outputs.get(ref)
+        if text is None and self.log is not None and ref.startswith("out-") and ref[4:].isdigit():
+            text = self._load_output(int(ref[4:]))
+        if text is None:
+            return f"Referência desconhecida ou expirada: {ref}"
+        piece = text[offset:offset + max(0, length)]
+        remaining = len(text) - offset - len(piece)
+        if remaining > 0:
+            piece += f"\n[... mais {remaining} caracteres; use offset={offset + len(piece)}]"
+        return piece
+
+    def load_tail(self):
+        """
+        Retoma a sessão a partir do log: lê do fim para o início só até
+        preencher o orçamento, sempre a partir do início de um turno.
+        Retorna o número de mensagens carregadas.
+        """
+        self.next_seq = self.log.last_seq(self.session_id)
+        self.seq_offsets = [(0, 0)]
+        self._reset()
+        loaded = []
+        total = estimate_tokens(self.messages[0])
+        turn = []
+        for seq, message, _ in self.log.tail(self.session_id):
+            if message["role"] == "tool":
+                # Sem o campo extra "name" (não faz parte da API)
+                message = {k: message[k] for k in ("role", "tool_call_id", "content")}
+                self.tool_seqs[message["tool_call_id"]] = seq
+                self.refs[message["tool_call_id"]] = f"out-{seq}"
+            turn.append(message)
+            total += estimate_tokens(message)
+            if message["role"] == "user":
+                # Turno completo: entra inteiro ou para a leitura
+                if loaded and total > self.budget:
+                    break
+                loaded = turn[::-1] + loaded
+                turn = []
+        # Turno interrompido: tool_calls sem resultado invalidam o pedido ao LLM
+        answered = {m["tool_call_id"] for m in loaded if m["role"] == "tool"}
+        for i, message in enumerate(loaded):
+            if any(tc["id"] not in answered for tc in message.get("tool_calls") or []):
+                loaded = loaded[:i]
+                break
+        self.messages += loaded
+        self.raw_tokens = sum(estimate_tokens(m) for m in self.messages)
+        return len(loaded)
+
+    def close_tool_calls(self, text):
+        """Responde às tool calls do turno atual que ficaram sem resultado (turno interrompido)"""
+        answered = {m["tool_call_id"] for m in self.messages if m["role"] == "tool"}
+        pending = []
+        for message in reversed(self.messages):
+            if message["role"] == "user":
+                break
+            pending[:0] = [tc for tc in message.get("tool_calls") or [] if tc["id"] not in answered]
+        for tc in pending:
+            self.add_tool_result(tc["id"], text, tc["function"]["name"])
+
+    def tokens(self):
+        return sum(estimate_tokens(m) for m in self.messages)
+
+    def snapshot(self):
+        """Estado serializável em JSON (para o armazenamento de sessões)"""
+        return {
+            "messages": self.messages,
+            "outputs": list(self.outputs.items()),
+            "refs": self.refs,
+            "compacted": sorted(self.compacted),
+            "raw_tokens": self.raw_tokens,
+            "next_ref": self._next_ref
+        }
+
+    def restore(self, state):
+        self.messages = state["messages"]
+        self.outputs = OrderedDict(state["outputs"])
+        self.refs = state["refs"]
+        self.compacted = set(state["compacted"])
+        self.raw_tokens = state["raw_tokens"]
+        self._next_ref = state["next_ref"]
+
+    def fit(self):
+        """Compacta o histórico até caber no orçamento; retorna os tokens a enviar"""
+        total = self.tokens()
+        if total <= self.budget:
+            return total
+        user_turns = [i for i, m in enumerate(self.messages) if m["role"] == "user"]
+        current_turn = user_turns[-1] if user_turns else len(self.messages)
+        
+        # 1) Resultados de ferramentas de turnos anteriores viram referências
+        for i in range(1, current_turn):
+            if total <= self.budget:
+                return total
+            message = self.messages[i]
+            if message["role"] != "tool" or message["tool_call_id"] in self.compacted:
+                continue
+            ref = self.refs.get(message["tool_call_id"]) or self.store_output(
+                message["content"], self.tool_seqs.get(message["tool_call_id"])
+            )
+            stub = {
+                "role": "tool",
+                "tool_call_id": message["tool_call_id"],
+                "content": f"[resultado antigo compactado em {ref}; use fetch_output]"
+            }
+            total += estimate_tokens(stub) - estimate_tokens(message)
+            self.messages[i] = stub
+            self.compacted.add(message["tool_call_id"])
+        
+        # 2) Descarta turnos antigos inteiros (nunca o turno atual)
+        while total > self.budget:
+            user_turns = [i for i, m in enumerate(self.messages) if m["role"] == "user"]
+            if len(user_turns) < 2:
+                break
+            dropped = self.messages[user_turns[0]:user_turns[1]]
+            del self.messages[user_turns[0]:user_turns[1]]
+            total -= sum(estimate_tokens(m) for m in dropped)
+        return total
+
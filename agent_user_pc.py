@@ -1,71 +1,157 @@
 import os
 import json
+import time
+import uuid
 import asyncio
+from types import SimpleNamespace
 from groq import Groq
 from mcp.client.session import ClientSession
-from mcp.client.stdio import StdioServerParameters, stdio_client
+from mcp.client.stdio import StdioServerParameters, stdio_client, get_default_environment
 import readline
+import tracing
+from agent_core import (
+    MODEL, SYSTEM_PROMPT, LLM_CACHE, LLM_TEMPERATURE, LLM_MAX_TOKENS, llm_cache, llm_cache_key,
+    parse_oob, schedule_tool_calls, tool_schema_version, load_tool_schemas, save_tool_schemas,
+    to_groq_tools, select_tools, ToolRouter, ConversationContext, ConversationLog, CONVERSATION_DB
+)
+
 # =========================
-# CONFIG
+# LLM
 # =========================
-MODEL = "moonshotai/kimi-k2-instruct-0905"
-SYSTEM_PROMPT = """
-Você é um Agente DevOps Local e Agente de Automação de PC.
-Você tem acesso a ferramentas MCP para:
-- executar comandos no terminal
-- manipular arquivos (ler, escrever, listar)
-- controlar mouse e teclado
-- trabalhar com Git
-- capturar screenshots
-
-Use as ferramentas sempre que necessário.
-Explique o que está fazendo de forma clara.
-Seja cuidadoso com comandos destrutivos.
-Sempre confirme antes de executar operações importantes.
-"""
-
 groq_client = Groq(
-    api_key=os.environ.get("GROQ_API_KEY")
+    api_key=os.environ.get("GROQ_API_KEY") or ("replay" if LLM_CACHE == "replay" else None)
 )
 
+def llm_complete(messages, tools):
+    """Chama o LLM (ou responde do cache); retorna (mensagem do assistente, usage, resultado do cache)"""
+    key = None
+    if llm_cache is not None:
+        key = llm_cache_key(messages, tools)
+        entry = llm_cache.get(key) if LLM_CACHE != "record" else None
+        if entry is not None:
+            tool_calls = [
+                SimpleNamespace(id=tc["id"], function=SimpleNamespace(name=tc["name"], arguments=tc["arguments"]))
+                for tc in entry["tool_calls"]
+            ]
+            return SimpleNamespace(content=entry["content"], tool_calls=tool_calls or None), None, "hit"
+        if LLM_CACHE == "replay":
+            raise RuntimeError(f"LLM_CACHE=replay: nenhuma resposta gravada para esta requisição ({key[:12]})")
+    
+    completion = groq_client.chat.completions.create(
+        model=MODEL,
+        messages=messages,
+        tools=tools,
+        temperature=LLM_TEMPERATURE,
+        max_tokens=LLM_MAX_TOKENS
+    )
+    message = completion.choices[0].message
+    if key is not None:
+        llm_cache.put(key, {
+            "content": message.content or "",
+            "tool_calls": [
+                {"id": tc.id, "name": tc.function.name, "arguments": tc.function.arguments}
+                for tc in message.tool_calls or []
+            ]
+        })
+    return message, completion.usage, "miss" if key is not None else None
+
+# =========================
+# EXECUÇÃO DE FERRAMENTAS
+# =========================
+async def execute_tool(session, tool_call, context, router):
+    """Executa uma tool call e retorna (argumentos, texto do resultado, erro?)"""
+    attributes = {
+        "tool.name": tool_call.function.name,
+        "tool.args.bytes": len(tool_call.function.arguments or "")
+    }
+    with tracing.span("tool.call", attributes) as span:
+        tool_args, result_text, failed = await _execute_tool(session, tool_call, context, router)
+        span.set("tool.result.bytes", len(result_text.encode("utf-8", errors="replace")))
+        if failed:
+            span.error(result_text)
+        return tool_args, result_text, failed
+
+async def _execute_tool(session, tool_call, context, router):
+    tool_name = tool_call.function.name
+    tool_args = json.loads(tool_call.function.arguments)
+    
+    try:
+        if tool_name == "fetch_output":
+            return tool_args, context.fetch(**tool_args), False
+        if tool_name == "request_tools":
+            return tool_args, router.expand(tool_args.get("groups")), False
+        
+        result = await session.call_tool(tool_name, tool_args)
+        
+        # Extrair texto do resultado
+        result_text = ""
+        if hasattr(result, 'content'):
+            for content_item in result.content:
+                oob = parse_oob(tool_name, getattr(content_item, 'text', None))
+                if oob is not None:
+                    # Imagem gravada em arquivo pelo servidor (MCP_OOB_DIR): só o placeholder
+                    mime_type, size, path = oob
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                    result_text += f"\n[imagem {mime_type}, {size} bytes]"
+                elif hasattr(content_item, 'text'):
+                    result_text += content_item.text
+                elif getattr(content_item, 'data', None) and getattr(content_item, 'mimeType', None):
+                    result_text += f"\n[imagem {content_item.mimeType}, {len(content_item.data) * 3 // 4} bytes]"
+        else:
+            result_text = str(result)
+        return tool_args, result_text, False
+        
+    except Exception as e:
+        return tool_args, f"Erro ao executar {tool_name}: {str(e)}", True
 
 async def main():
     if 'DISPLAY' not in os.environ:
         os.environ['DISPLAY'] = ':0'
     
+    # O stdio_client só repassa um ambiente mínimo; as opções MCP_* e AGENT_*
+    # (cache, executor nativo, tracing) precisam chegar ao servidor
+    env = get_default_environment()
+    env.update({k: v for k, v in os.environ.items() if k.startswith(("MCP_", "AGENT_"))})
     server_params = StdioServerParameters(
         command="python",
-        args=["mcp_pc_devops_agent.py"]
+        args=["mcp_pc_devops_agent.py"],
+        env=env
     )
     
     print("Conectando ao servidor MCP...")
+    started = time.perf_counter()
     
     async with stdio_client(server_params) as (read, write):
         async with ClientSession(read, write) as session:
             await session.initialize()
+            print(f"✓ Servidor MCP pronto em {1000 * (time.perf_counter() - started):.0f} ms")
             
-            tools_response = await session.list_tools()
+            # Schemas no formato Groq: do cache em disco ou de list_tools()
+            version = tool_schema_version()
+            all_tools = load_tool_schemas(version)
+            if all_tools is None:
+                all_tools = to_groq_tools((await session.list_tools()).tools)
+                save_tool_schemas(version, all_tools)
+            groq_tools = select_tools(all_tools)
             print("\n🔧 Ferramentas MCP disponíveis:")
-            for tool in tools_response.tools:
-                print(f"  ✓ {tool.name}: {tool.description}")
+            for tool in groq_tools:
+                print(f"  ✓ {tool['function']['name']}: {tool['function']['description']}")
+            if len(groq_tools) < len(all_tools):
+                print(f"  ({len(all_tools) - len(groq_tools)} ferramentas de GUI ocultas: sem display)")
             print()
             
-            # Converter ferramentas MCP para formato Groq
-            groq_tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": tool.name,
-                        "description": tool.description,
-                        "parameters": tool.inputSchema
-                    }
-                }
-                for tool in tools_response.tools
-            ]
-            
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT}
-            ]
+            # AGENT_SESSION=<id> retoma uma conversa gravada no log
+            session_id = os.environ.get("AGENT_SESSION") or uuid.uuid4().hex
+            log = ConversationLog(CONVERSATION_DB) if CONVERSATION_DB else None
+            context = ConversationContext(SYSTEM_PROMPT, log=log, session_id=session_id)
+            if log:
+                loaded = context.load_tail()
+                if loaded:
+                    print(f"📜 Conversa retomada: {loaded} mensagens recentes carregadas")
+                print(f"   Sessão: {session_id} (retome com AGENT_SESSION={session_id})\n")
             
             print("Agente MCP (Groq + LLaMA) iniciado")
             print("Digite 'exit' ou 'quit' para sair")
@@ -82,37 +168,57 @@ async def main():
                     break
                 
                 if user_input.lower() == "clear":
-                    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+                    context.clear()
+                    context.flush()
                     print("Histórico limpo\n")
                     continue
                 
-                messages.append({"role": "user", "content": user_input})
+                # Subconjunto de ferramentas do turno (mensagem + ferramentas recentes)
+                router = ToolRouter(groq_tools, user_input, context.messages)
+                context.append({"role": "user", "content": user_input})
+                turn_span = tracing.start_span("agent.turn", {"message.chars": len(user_input)})
+                turn_token = tracing.activate(turn_span)
                 
                 # Loop de iteração do agente
                 max_iterations = 10
                 iteration = 0
+                tokens_sent = 0
+                tokens_raw = 0
                 
                 while iteration < max_iterations:
                     iteration += 1
                     
+                    sent = context.fit()
+                    tokens_sent += sent
+                    tokens_raw += context.raw_tokens
+                    
+                    tools = router.selected()
+                    attributes = {
+                        "llm.iteration": iteration,
+                        "llm.messages": len(context.messages),
+                        "llm.tokens.sent": sent,
+                        "llm.tools": len(tools)
+                    }
                     try:
-                        completion = groq_client.chat.completions.create(
-                            model=MODEL,
-                            messages=messages,
-                            tools=groq_tools,
-                            temperature=0.2,
-                            max_tokens=2048
-                        )
+                        with tracing.span("llm.completion", attributes) as llm_span:
+                            assistant_msg, usage, cache_result = llm_complete(context.messages, tools)
+                            if usage:
+                                llm_span.set("llm.tokens.prompt", usage.prompt_tokens)
+                                llm_span.set("llm.tokens.completion", usage.completion_tokens)
+                            if cache_result:
+                                llm_span.set("llm.cache", cache_result)
+                            llm_span.set("llm.tool_calls", len(assistant_msg.tool_calls or []))
                     except Exception as e:
+                        if router.recover(e):
+                            continue
                         print(f"\n❌ Erro na API Groq: {e}")
+                        turn_span.error(str(e))
                         break
                     
-                    assistant_msg = completion.choices[0].message
-                    
                     # PROCESSAR TOOL CALLS
                     # =========================
                     if assistant_msg.tool_calls:
-                        messages.append({
+                        context.append({
                             "role": "assistant",
                             "content": assistant_msg.content or "",
                             "tool_calls": [
@@ -128,48 +234,28 @@ async def main():
                             ]
                         })
                         
-                        # Executar cada ferramenta
-                        for tool_call in assistant_msg.tool_calls:
-                            tool_name = tool_call.function.name
-                            tool_args = json.loads(tool_call.function.arguments)
-                            
-                            print(f"\n🛠️  Executando: {tool_name}")
-                            print(f"    Parâmetros: {json.dumps(tool_args, indent=2, ensure_ascii=False)}")
+                        # Executar ferramentas (leituras consecutivas em paralelo)
+                        for batch in schedule_tool_calls(assistant_msg.tool_calls):
+                            results = await asyncio.gather(
+                                *(execute_tool(session, tool_call, context, router) for tool_call in batch)
+                            )
                             
-                            try:
-                                result = await session.call_tool(tool_name, tool_args)
+                            # Resultados entram no histórico na ordem original dos tool_call_id
+                            for tool_call, (tool_args, result_text, failed) in zip(batch, results):
+                                print(f"\n🛠️  Executando: {tool_call.function.name}")
+                                print(f"    Parâmetros: {json.dumps(tool_args, indent=2, ensure_ascii=False)}")
                                 
-                                # Extrair texto do resultado
-                                result_text = ""
-                                if hasattr(result, 'content'):
-                                    for content_item in result.content:
-                                        if hasattr(content_item, 'text'):
-                                            result_text += content_item.text
+                                if failed:
+                                    print(f"    ✗ {result_text}")
                                 else:
-                                    result_text = str(result)
-                                
-                                # Limitar tamanho da saída exibida
-                                display_result = result_text[:500]
-                                if len(result_text) > 500:
-                                    display_result += f"\n... (mais {len(result_text) - 500} caracteres)"
-                                
-                                print(f"    ✓ Resultado: {display_result}")
+                                    # Limitar tamanho da saída exibida
+                                    display_result = result_text[:500]
+                                    if len(result_text) > 500:
+                                        display_result += f"\n... (mais {len(result_text) - 500} caracteres)"
+                                    print(f"    ✓ Resultado: {display_result}")
                                 
                                 # Adicionar resultado ao histórico
-                                messages.append({
-                                    "role": "tool",
-                                    "tool_call_id": tool_call.id,
-                                    "content": result_text
-                                })
-                                
-                            except Exception as e:
-                                error_msg = f"Erro ao executar {tool_name}: {str(e)}"
-                                print(f"    ✗ {error_msg}")
-                                messages.append({
-                                    "role": "tool",
-                                    "tool_call_id": tool_call.id,
-                                    "content": error_msg
-                                })
+                                context.add_tool_result(tool_call.id, result_text, tool_call.function.name)
                         
                         continue
                     
@@ -179,7 +265,7 @@ async def main():
                     else:
                         if assistant_msg.content:
                             print(f"\n🤖 {assistant_msg.content}\n")
-                            messages.append({
+                            context.append({
                                 "role": "assistant",
                                 "content": assistant_msg.content
                             })
@@ -187,9 +273,19 @@ async def main():
                 
                 if iteration >= max_iterations:
                     print("\n⚠️  Limite de iterações atingido\n")
+                
+                context.flush()
+                turn_span.set("turn.tokens.sent", tokens_sent)
+                turn_span.set("turn.tokens.raw", tokens_raw)
+                turn_span.set("turn.tool_groups", ",".join(sorted(router.groups)))
+                turn_span.set("turn.tool_expansions", router.expansions)
+                tracing.deactivate(turn_token)
+                turn_span.end()
+                
+                print(f"📉 Tokens enviados neste turno: {tokens_sent} (sem gestão de contexto: {tokens_raw})\n")
 
 if __name__ == "__main__":
-    if not os.environ.get("GROQ_API_KEY"):
+    if not os.environ.get("GROQ_API_KEY") and LLM_CACHE != "replay":
         print("Erro: GROQ_API_KEY não configurada")
         print("  Execute: export GROQ_API_KEY='sua_chave_aqui'")
         exit(1)
@@ -70,6 +70,8 @@ echo [*] Compilando (build completo)...
 pyinstaller --name mcp-agent ^
     --add-data "index.html;." ^
     --add-data "mcp_pc_devops_agent.py;." ^
+    --add-data "tracing.py;." ^
+    --add-data "agent_core.py;." ^
     --hidden-import=mcp ^
     --hidden-import=mcp.client ^
     --hidden-import=mcp.server ^
@@ -93,6 +95,8 @@ pyinstaller --name mcp-agent ^
     --onefile ^
     --add-data "index.html;." ^
     --add-data "mcp_pc_devops_agent.py;." ^
+    --add-data "tracing.py;." ^
+    --add-data "agent_core.py;." ^
     --hidden-import=mcp ^
     --hidden-import=mcp.client ^
     --hidden-import=mcp.server ^
@@ -117,6 +121,8 @@ pyinstaller --name mcp-agent ^
     --windowed ^
     --add-data "index.html;." ^
     --add-data "mcp_pc_devops_agent.py;." ^
+    --add-data "tracing.py;." ^
+    --add-data "agent_core.py;." ^
     --hidden-import=mcp ^
     --hidden-import=fastmcp ^
     --hidden-import=groq ^
@@ -162,7 +168,7 @@ echo.
 echo [*] Criando pacote distribuivel...
 if not exist release mkdir release
 if exist dist\mcp-agent.exe (
-    powershell Compress-Archive -Path dist\mcp-agent.exe,index.html,mcp_pc_devops_agent.py -DestinationPath release\mcp-agent-windows.zip -Force
+    powershell Compress-Archive -Path dist\mcp-agent.exe,index.html,mcp_pc_devops_agent.py,tracing.py,agent_core.py -DestinationPath release\mcp-agent-windows.zip -Force
     echo [OK] Pacote criado: release\mcp-agent-windows.zip
 ) else (
     echo [ERRO] Executavel nao encontrado
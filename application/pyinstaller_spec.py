@@ -17,6 +17,8 @@ hiddenimports = []
 datas += [
     ('index.html', '.'),
     ('mcp_pc_devops_agent.py', '.'),
+    ('tracing.py', '.'),
+    ('agent_core.py', '.'),
 ]
 
 # Coletar submódulos MCP
@@ -1,109 +1,833 @@
 import os
 import json
 import asyncio
+import time
+import re
+import uuid
+import base64
+import signal
+import socket
+import tempfile
+import multiprocessing
+from types import SimpleNamespace
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 from aiohttp import web
 import aiohttp
-from groq import Groq
+import httpx
+from groq import AsyncGroq
 from mcp.client.session import ClientSession
-from mcp.client.stdio import StdioServerParameters, stdio_client
-
-MODEL = "moonshotai/kimi-k2-instruct-0905"
-SYSTEM_PROMPT = """
-Você é um Agente DevOps Local e Agente de Automação de PC.
-Você tem acesso a ferramentas MCP para:
-- executar comandos no terminal
-- manipular arquivos (ler, escrever, listar)
-- controlar mouse e teclado
-- trabalhar com Git
-- capturar screenshots
-
-Use as ferramentas sempre que necessário.
-Explique o que está fazendo de forma clara.
-Seja cuidadoso com comandos destrutivos.
-Sempre confirme antes de executar operações importantes.
-"""
-
-groq_client = Groq(api_key=os.environ.get("GROQ_API_KEY"))
-
-mcp_client_context = None
-mcp_session = None
+from mcp.client.stdio import StdioServerParameters, stdio_client, get_default_environment
+from mcp.client.streamable_http import streamablehttp_client
+from mcp.types import ImageContent, ClientNotification, CancelledNotification, CancelledNotificationParams
+import tracing
+from agent_core import (
+    MODEL, SYSTEM_PROMPT, LLM_CACHE, LLM_TEMPERATURE, LLM_MAX_TOKENS, llm_cache, llm_cache_key,
+    GUI_TOOLS, parse_oob, schedule_tool_calls, tool_schema_version, load_tool_schemas,
+    save_tool_schemas, to_groq_tools, select_tools, ToolRouter, ConversationContext,
+    SQLiteFile, ConversationLog, CONVERSATION_DB, HISTORY_PREVIEW_CHARS
+)
+
+# =========================
+# MÉTRICAS (formato de texto do Prometheus)
+# =========================
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(34), chr(39))}"' for k, v in labels) + "}"
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        series = self.series.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["buckets"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            for bound, count in zip(self.buckets, series["buckets"]):
+                lines.append(f"{self.name}_bucket{_labels(key + (('le', bound),))} {count}")
+            lines.append(f"{self.name}_bucket{_labels(key + (('le', '+Inf'),))} {series['count']}")
+            lines.append(f"{self.name}_sum{_labels(key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_labels(key)} {series['count']}")
+        return lines
+
+def gauge(name, help, samples, kind="gauge"):
+    """Renderiza um gauge (ou contador já totalizado) a partir de [(labels, valor)]"""
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(tuple(sorted(labels.items())))} {value}")
+    return lines
+
+LLM_LATENCY = Histogram("agent_llm_request_seconds", "Latência das chamadas ao LLM")
+LLM_TOKENS = Counter("agent_llm_tokens_total", "Tokens reportados pelo LLM")
+LLM_CACHE_REQUESTS = Counter("agent_llm_cache_requests_total", "Consultas ao cache de respostas do LLM por resultado")
+TOOL_LATENCY = Histogram("agent_tool_call_seconds", "Latência das chamadas de ferramentas MCP (visão do cliente)")
+TURN_LATENCY = Histogram("agent_turn_seconds", "Duração de um turno completo do agente")
+TURN_TTFB = Histogram("agent_turn_ttfb_seconds", "Tempo até o primeiro frame de um turno")
+WS_CONNECTIONS = Counter("agent_websocket_connections_total", "Conexões WebSocket aceitas")
+WS_MESSAGES = Counter("agent_websocket_messages_total", "Mensagens WebSocket recebidas")
+WS_DROPPED_BYTES = Counter("agent_websocket_dropped_bytes_total", "Bytes de saída parcial de ferramentas omitidos (cliente lento)")
+
+active_websockets = 0
+event_loop_lag = 0.0
+
+async def monitor_event_loop(interval=0.5):
+    """Mede o atraso do event loop: quanto um sleep demora além do pedido"""
+    global event_loop_lag
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        event_loop_lag = max(0.0, time.perf_counter() - start - interval)
+
+def process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# =========================
+# LLM (cliente assíncrono)
+# =========================
+LLM_TIMEOUT = float(os.environ.get("LLM_TIMEOUT", "120"))
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", "16"))
+LLM_SESSION_CONCURRENCY = int(os.environ.get("LLM_SESSION_CONCURRENCY", "1"))
+
+# GROQ_BASE_URL permite apontar para um endpoint local (ex: LLM falso para testes de carga)
+groq_client = AsyncGroq(
+    api_key=os.environ.get("GROQ_API_KEY") or ("replay" if LLM_CACHE == "replay" else None),
+    base_url=os.environ.get("GROQ_BASE_URL") or None,
+    timeout=LLM_TIMEOUT
+)
+
+# Limite global de chamadas simultâneas ao LLM (todas as sessões)
+llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+async def _llm_stream(messages, tools, on_token=None):
+    """Consome o stream do LLM, repassando deltas de texto e montando as tool calls"""
+    async with llm_semaphore:
+        stream = await groq_client.chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            tools=tools,
+            temperature=LLM_TEMPERATURE,
+            max_tokens=LLM_MAX_TOKENS,
+            stream=True
+        )
+        content = ""
+        calls = {}
+        # Fecha a resposta HTTP também quando o turno é cancelado a meio do stream
+        async with stream:
+            async for chunk in stream:
+                usage = getattr(chunk, "usage", None) or getattr(getattr(chunk, "x_groq", None), "usage", None)
+                if usage:
+                    LLM_TOKENS.inc(usage.prompt_tokens or 0, type="prompt")
+                    LLM_TOKENS.inc(usage.completion_tokens or 0, type="completion")
+                    span = tracing.current_span()
+                    if span:
+                        span.set("llm.tokens.prompt", usage.prompt_tokens)
+                        span.set("llm.tokens.completion", usage.completion_tokens)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content += delta.content
+                    if on_token:
+                        await on_token(delta.content)
+                for tc in delta.tool_calls or []:
+                    entry = calls.setdefault(tc.index, {"id": "", "name": "", "arguments": ""})
+                    if tc.id:
+                        entry["id"] = tc.id
+                    if tc.function:
+                        entry["name"] += tc.function.name or ""
+                        entry["arguments"] += tc.function.arguments or ""
+        
+        tool_calls = [
+            SimpleNamespace(
+                id=entry["id"],
+                function=SimpleNamespace(name=entry["name"], arguments=entry["arguments"] or "{}")
+            )
+            for _, entry in sorted(calls.items())
+        ]
+        return content, tool_calls
+
+async def _llm_complete(messages, tools, session_semaphore=None, on_token=None):
+    if session_semaphore is None:
+        return await asyncio.wait_for(_llm_stream(messages, tools, on_token), timeout=LLM_TIMEOUT)
+    async with session_semaphore:
+        return await asyncio.wait_for(_llm_stream(messages, tools, on_token), timeout=LLM_TIMEOUT)
+
+def _cache_entry(content, tool_calls):
+    return {
+        "content": content or "",
+        "tool_calls": [
+            {"id": tc.id, "name": tc.function.name, "arguments": tc.function.arguments}
+            for tc in tool_calls or []
+        ]
+    }
+
+async def _from_cache(entry, on_token):
+    # O texto inteiro vai num único delta
+    if on_token and entry["content"]:
+        await on_token(entry["content"])
+    tool_calls = [
+        SimpleNamespace(id=tc["id"], function=SimpleNamespace(name=tc["name"], arguments=tc["arguments"]))
+        for tc in entry["tool_calls"]
+    ]
+    return entry["content"], tool_calls
+
+# Requisições idênticas em curso: as seguintes esperam pela primeira
+llm_inflight = {}
+
+def _cache_result(result):
+    LLM_CACHE_REQUESTS.inc(result=result)
+    span = tracing.current_span()
+    if span:
+        span.set("llm.cache", result)
+
+async def llm_complete(messages, tools, session_semaphore=None, on_token=None):
+    """
+    Chama o LLM sem bloquear o event loop, respeitando limites e timeout.
+    Retorna (conteúdo, tool_calls); on_token recebe os deltas de texto.
+    """
+    if llm_cache is None:
+        return await _llm_complete(messages, tools, session_semaphore, on_token)
+    
+    key = llm_cache_key(messages, tools)
+    if LLM_CACHE != "record":
+        entry = llm_cache.get(key)
+        if entry is not None:
+            _cache_result("hit")
+            return await _from_cache(entry, on_token)
+        while (pending := llm_inflight.get(key)) is not None:
+            try:
+                entry = await asyncio.shield(pending)
+                _cache_result("coalesced")
+                return await _from_cache(entry, on_token)
+            except Exception:
+                # A requisição original falhou: a primeira a acordar tenta de novo
+                # e as restantes esperam por ela
+                if llm_inflight.get(key) is pending:
+                    break
+        if LLM_CACHE == "replay":
+            _cache_result("replay_miss")
+            raise RuntimeError(f"LLM_CACHE=replay: nenhuma resposta gravada para esta requisição ({key[:12]})")
+    
+    _cache_result("miss")
+    future = asyncio.get_running_loop().create_future()
+    llm_inflight[key] = future
+    try:
+        content, tool_calls = await _llm_complete(messages, tools, session_semaphore, on_token)
+        entry = _cache_entry(content, tool_calls)
+        llm_cache.put(key, entry)
+        future.set_result(entry)
+        return content, tool_calls
+    except BaseException as e:
+        future.set_exception(e if isinstance(e, Exception) else RuntimeError("Requisição ao LLM cancelada"))
+        future.exception()  # Sem quem espere, evita o aviso de exceção não lida
+        raise
+    finally:
+        if llm_inflight.get(key) is future:
+            del llm_inflight[key]
+
+# =========================
+# POOL DE SERVIDORES MCP
+# =========================
+MCP_POOL_SIZE = int(os.environ.get("MCP_POOL_SIZE", "2"))
+MCP_START_TIMEOUT = float(os.environ.get("MCP_START_TIMEOUT", "30"))
+MCP_HEALTH_INTERVAL = float(os.environ.get("MCP_HEALTH_INTERVAL", "10"))
+MCP_PING_TIMEOUT = float(os.environ.get("MCP_PING_TIMEOUT", "5"))
+
+# stdio: cada worker inicia o seu servidor. http/unix: os workers ligam-se a um
+# servidor de longa duração já iniciado (MCP_TRANSPORT=http|unix python mcp_pc_devops_agent.py)
+MCP_TRANSPORT = os.environ.get("MCP_TRANSPORT", "stdio")
+MCP_URL = os.environ.get("MCP_URL", "http://127.0.0.1:8765/mcp")
+MCP_SOCKET = os.environ.get("MCP_SOCKET") or os.path.join(
+    tempfile.gettempdir(), f"mcp-devops-{os.environ.get('USER', 'user')}", "mcp.sock"
+)
+# Ferramentas que criam processos com handle e as que operam sobre eles: em
+# stdio o handle só existe no servidor do worker que o criou
+HANDLE_CREATING_TOOLS = {"start_command", "run_command"}
+HANDLE_TOOLS = {"read_output", "send_input", "cancel_command"}
+HANDLE_PATTERN = re.compile(r"handle=([0-9a-f]+)")
+MCP_MAX_HANDLES = 1024
+
+def mcp_server_params():
+    # O stdio_client só repassa um ambiente mínimo; as opções MCP_* e AGENT_*
+    # (cache, executor nativo, tracing) precisam chegar ao servidor
+    env = get_default_environment()
+    env.update({k: v for k, v in os.environ.items() if k.startswith(("MCP_", "AGENT_"))})
+    # Quantos servidores partilham os arquivos (caches por processo)
+    env["MCP_PEER_SERVERS"] = str(MCP_POOL_SIZE * WEB_WORKERS)
+    return StdioServerParameters(
+        command="python",
+        args=["mcp_pc_devops_agent.py"],
+        env=env
+    )
+
+def _uds_client_factory(headers=None, timeout=None, auth=None):
+    return httpx.AsyncClient(
+        transport=httpx.AsyncHTTPTransport(uds=MCP_SOCKET),
+        headers=headers, timeout=timeout, auth=auth, follow_redirects=True
+    )
+
+@asynccontextmanager
+async def mcp_connect():
+    """Abre os streams (leitura, escrita) do transporte configurado"""
+    if MCP_TRANSPORT == "stdio":
+        async with stdio_client(mcp_server_params()) as (read_stream, write_stream):
+            yield read_stream, write_stream
+    elif MCP_TRANSPORT in ("http", "unix"):
+        url, factory = MCP_URL, None
+        if MCP_TRANSPORT == "unix":
+            # O host é ignorado: a ligação vai para o socket
+            url = "http://localhost" + (httpx.URL(MCP_URL).path or "/mcp")
+            factory = _uds_client_factory
+        kwargs = {"httpx_client_factory": factory} if factory else {}
+        async with streamablehttp_client(url, **kwargs) as (read_stream, write_stream, _):
+            yield read_stream, write_stream
+    else:
+        raise RuntimeError(f"MCP_TRANSPORT inválido: {MCP_TRANSPORT} (use stdio, http ou unix)")
+
+def resolve_oob(result, tool_name):
+    """Troca as referências [oob] (imagens gravadas em arquivo pelo servidor) pelo conteúdo"""
+    content = getattr(result, "content", None)
+    if not content:
+        return result
+    for i, item in enumerate(content):
+        oob = parse_oob(tool_name, getattr(item, "text", None))
+        if oob is None:
+            continue
+        mime_type, _, path = oob
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.unlink(path)
+        except OSError as e:
+            item.text = f"[imagem fora de banda indisponível: {e}]"
+            continue
+        content[i] = ImageContent(type="image", data=base64.b64encode(data).decode("ascii"), mimeType=mime_type)
+    return result
+
+class MCPWorker:
+    """Uma sessão MCP: um processo próprio (stdio) ou uma ligação ao servidor partilhado"""
+
+    def __init__(self, index):
+        self.index = index
+        self.session = None
+        self.in_flight = 0
+        self.calls = 0
+        self.errors = 0
+        self.restarts = 0
+        self.total_latency = 0.0
+        self.last_latency = 0.0
+        self.startup_ms = None
+        self._task = None
+        self._ready = None
+        self._stop = None
+
+    @property
+    def alive(self):
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def start(self):
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+        ready_task = asyncio.create_task(self._ready.wait())
+        done, _ = await asyncio.wait(
+            {ready_task, self._task},
+            timeout=MCP_START_TIMEOUT,
+            return_when=asyncio.FIRST_COMPLETED
+        )
+        if ready_task not in done:
+            ready_task.cancel()
+            if self._task.done():
+                raise RuntimeError(f"Worker MCP {self.index} terminou: {self._task.exception()}")
+            self._task.cancel()
+            raise RuntimeError(f"Worker MCP {self.index} não iniciou em {MCP_START_TIMEOUT}s")
+
+    async def _run(self):
+        # Os contextos de transporte/sessão entram e saem na mesma task
+        started = time.perf_counter()
+        try:
+            async with mcp_connect() as (read_stream, write_stream):
+                async with ClientSession(read_stream, write_stream) as session:
+                    await session.initialize()
+                    # Arranque a frio: do spawn (ou ligação) até o initialize() concluído
+                    self.startup_ms = round(1000 * (time.perf_counter() - started), 1)
+                    print(f"✓ Worker MCP {self.index} pronto em {self.startup_ms} ms")
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        finally:
+            self.session = None
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._stop.set()
+        try:
+            await asyncio.wait_for(self._task, timeout=5)
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            self._task.cancel()
+        except Exception:
+            pass
+
+    async def restart(self):
+        print(f"♻️  Reiniciando worker MCP {self.index}")
+        await self.stop()
+        self.restarts += 1
+        await self.start()
+
+    async def ping(self):
+        await asyncio.wait_for(self.session.send_ping(), timeout=MCP_PING_TIMEOUT)
+
+    async def call_tool(self, tool_name, tool_args, progress_callback=None):
+        if not self.alive:
+            raise RuntimeError(f"Worker MCP {self.index} indisponível")
+        self.in_flight += 1
+        start = time.perf_counter()
+        outcome = "ok"
+        # Id que a sessão vai atribuir a este pedido (para notifications/cancelled)
+        request_id = getattr(self.session, "_request_id", None)
+        try:
+            result = await self.session.call_tool(
+                tool_name, tool_args, progress_callback=progress_callback
+            )
+            if getattr(result, "isError", False):
+                outcome = "error"
+            return resolve_oob(result, tool_name)
+        except asyncio.CancelledError:
+            outcome = "cancelled"
+            if request_id is not None:
+                await self.cancel_request(request_id, "Cancelado pelo usuário")
+            raise
+        except Exception:
+            self.errors += 1
+            outcome = "exception"
+            raise
+        finally:
+            self.in_flight -= 1
+            self.calls += 1
+            self.last_latency = time.perf_counter() - start
+            self.total_latency += self.last_latency
+            TOOL_LATENCY.observe(self.last_latency, tool=tool_name, outcome=outcome)
+
+    async def cancel_request(self, request_id, reason):
+        """Pede ao servidor que interrompa um pedido em curso (a ferramenta recebe o cancelamento)"""
+        notification = ClientNotification(CancelledNotification(
+            method="notifications/cancelled",
+            params=CancelledNotificationParams(requestId=request_id, reason=reason)
+        ))
+        try:
+            await asyncio.wait_for(self.session.send_notification(notification), timeout=1)
+        except Exception:
+            pass
+
+    def stats(self):
+        return {
+            "worker": self.index,
+            "alive": self.alive,
+            "queue_depth": self.in_flight,
+            "calls": self.calls,
+            "errors": self.errors,
+            "restarts": self.restarts,
+            "startup_ms": self.startup_ms,
+            "avg_latency_ms": round(1000 * self.total_latency / self.calls, 2) if self.calls else 0.0,
+            "last_latency_ms": round(1000 * self.last_latency, 2)
+        }
+
+class MCPPool:
+    """Pool de servidores MCP com despacho para o worker menos ocupado"""
+
+    def __init__(self, size):
+        self.workers = [MCPWorker(i) for i in range(max(1, size))]
+        self.affinity = {}
+        # handle de processo -> índice do worker que o criou
+        self.handles = OrderedDict()
+        self._health_task = None
+
+    async def start(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def list_tools(self):
+        return await self.workers[0].session.list_tools()
+
+    async def stop(self):
+        if self._health_task:
+            self._health_task.cancel()
+        await asyncio.gather(*(worker.stop() for worker in self.workers), return_exceptions=True)
+
+    def pick(self, tool_name, session_id=None, tool_args=None):
+        alive = [w for w in self.workers if w.alive]
+        if not alive:
+            raise RuntimeError("Nenhum worker MCP disponível")
+        if tool_name in HANDLE_TOOLS and tool_args:
+            index = self.handles.get(tool_args.get("handle"))
+            if index is not None and self.workers[index].alive:
+                return self.workers[index]
+        least_busy = min(alive, key=lambda w: w.in_flight)
+        if session_id is None or tool_name not in GUI_TOOLS:
+            return least_busy
+        index = self.affinity.get(session_id)
+        if index is not None and self.workers[index].alive:
+            return self.workers[index]
+        self.affinity[session_id] = least_busy.index
+        return least_busy
+
+    def release(self, session_id):
+        self.affinity.pop(session_id, None)
+
+    async def call_tool(self, tool_name, tool_args, session_id=None, progress_callback=None):
+        if tool_name == "abort" and MCP_TRANSPORT == "stdio":
+            return await self._broadcast(tool_name, tool_args)
+        worker = self.pick(tool_name, session_id, tool_args)
+        result = await worker.call_tool(tool_name, tool_args, progress_callback)
+        if tool_name in HANDLE_CREATING_TOOLS:
+            self._remember_handles(result, worker)
+        return result
+
+    def _remember_handles(self, result, worker):
+        for item in getattr(result, "content", None) or []:
+            for handle in HANDLE_PATTERN.findall(getattr(item, "text", None) or ""):
+                self.handles[handle] = worker.index
+                self.handles.move_to_end(handle)
+        while len(self.handles) > MCP_MAX_HANDLES:
+            self.handles.popitem(last=False)
+
+    async def _broadcast(self, tool_name, tool_args):
+        """Executa em todos os workers vivos (ex: abort precisa chegar a cada servidor)"""
+        alive = [w for w in self.workers if w.alive]
+        if not alive:
+            raise RuntimeError("Nenhum worker MCP disponível")
+        results = await asyncio.gather(
+            *(w.call_tool(tool_name, tool_args) for w in alive), return_exceptions=True
+        )
+        ok = [r for r in results if not isinstance(r, BaseException)]
+        if not ok:
+            raise results[0]
+        # Um resultado só, com o texto de cada worker
+        texts = [item.text for r in ok for item in (getattr(r, "content", None) or []) if getattr(item, "text", None)]
+        first = next((item for item in ok[0].content or [] if getattr(item, "text", None)), None)
+        if first is not None:
+            first.text = "\n".join(texts)
+        return ok[0]
+
+    async def _check(self, worker):
+        # Worker ocupado (ex: wait/run_command longo) pode não responder ao ping
+        if worker.alive and worker.in_flight > 0:
+            return
+        try:
+            if not worker.alive:
+                raise RuntimeError("processo terminou")
+            await worker.ping()
+        except Exception as e:
+            print(f"⚠️  Worker MCP {worker.index} sem resposta: {e}")
+            try:
+                await worker.restart()
+            except Exception as e:
+                print(f"❌ Falha ao reiniciar worker MCP {worker.index}: {e}")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(MCP_HEALTH_INTERVAL)
+            await asyncio.gather(*(self._check(w) for w in self.workers))
+
+    def stats(self):
+        return [worker.stats() for worker in self.workers]
+
+mcp_pool = None
 mcp_tools = []
+# Frame "tools" pré-serializado, enviado tal como está a cada WebSocket
+tools_frame = json.dumps({"type": "tools", "tools": []})
 
 async def initialize_mcp():
-    """Inicializa a conexão global com o servidor MCP"""
-    global mcp_client_context, mcp_session, mcp_tools
+    """Inicializa o pool de servidores MCP"""
+    global mcp_pool, mcp_tools, tools_frame
     
     if 'DISPLAY' not in os.environ:
         os.environ['DISPLAY'] = ':0'
     
-    server_params = StdioServerParameters(
-        command="python",
-        args=["mcp_pc_devops_agent.py"]
-    )
-    
-    print(" Conectando ao servidor MCP...")
+    print(f" Conectando ao servidor MCP ({MCP_POOL_SIZE} workers, transporte {MCP_TRANSPORT})...")
     
     try:
-        mcp_client_context = stdio_client(server_params)
-        read_stream, write_stream = await mcp_client_context.__aenter__()
-        
-        session_context = ClientSession(read_stream, write_stream)
-        mcp_session = await session_context.__aenter__()
-        await mcp_session.initialize()
-        
-        tools_response = await mcp_session.list_tools()
-        mcp_tools = [
-            {
-                "type": "function",
-                "function": {
-                    "name": tool.name,
-                    "description": tool.description,
-                    "parameters": tool.inputSchema
-                }
-            }
-            for tool in tools_response.tools
-        ]
+        mcp_pool = MCPPool(MCP_POOL_SIZE)
+        await mcp_pool.start()
+        version = tool_schema_version()
+        tools = load_tool_schemas(version)
+        if tools is None:
+            tools = to_groq_tools((await mcp_pool.list_tools()).tools)
+            save_tool_schemas(version, tools)
+        else:
+            print(f"✓ Schemas de ferramentas do cache ({version})")
+        mcp_tools = select_tools(tools)
+        tools_frame = json.dumps({
+            "type": "tools",
+            "tools": [
+                {"name": t["function"]["name"], "description": t["function"]["description"]}
+                for t in mcp_tools
+            ]
+        }, ensure_ascii=False)
         
-        print(f"✓ MCP inicializado com {len(mcp_tools)} ferramentas")
-        return tools_response.tools
+        hidden = len(tools) - len(mcp_tools)
+        print(f"✓ MCP inicializado com {len(mcp_tools)} ferramentas"
+              + (f" ({hidden} de GUI ocultas: sem display)" if hidden else ""))
+        return mcp_tools
         
     except Exception as e:
         print(f"❌ Erro ao inicializar MCP: {e}")
         raise
 
+# =========================
+# SESSÃO DO USUÁRIO
+# =========================
+# Log persistente da conversa (criado no arranque se CONVERSATION_DB)
+conversation_log = None
+
 class UserSession:
     def __init__(self, session_id):
         self.session_id = session_id
-        self.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.context = ConversationContext(SYSTEM_PROMPT, log=conversation_log, session_id=session_id)
+        self.tool_log = []
+        self.router = None
+        self.llm_semaphore = asyncio.Semaphore(LLM_SESSION_CONCURRENCY)
+        # Resultados truncados no navegador, por ID da tool call ("result_chunk")
+        self.results = OrderedDict()
+        self.results_size = 0
+    
+    @property
+    def messages(self):
+        return self.context.messages
+    
+    def snapshot(self):
+        state = {"tool_log": self.tool_log[-SESSION_TOOL_LOG:]}
+        if self.context.log is None:
+            # Sem log persistente, o contexto inteiro vai para o armazenamento
+            state["context"] = self.context.snapshot()
+        return state
+    
+    def restore(self, state):
+        if "context" in state:
+            self.context.restore(state["context"])
+        self.tool_log = state.get("tool_log", [])
+    
+    def keep_result(self, tool_call_id, text):
+        self.results[tool_call_id] = text
+        self.results_size += len(text)
+        # O mais recente fica sempre, mesmo acima do limite
+        while self.results_size > WS_RESULT_STORE_CHARS and len(self.results) > 1:
+            _, old = self.results.popitem(last=False)
+            self.results_size -= len(old)
     
-    async def process_message(self, user_message):
-        """Processa mensagem do usuário"""
-        self.messages.append({"role": "user", "content": user_message})
+    def result_chunk(self, tool_call_id, offset=0):
+        """Frame com o próximo bloco de um resultado truncado"""
+        text = self.results.get(tool_call_id)
+        if text is None:
+            return {"type": "result_chunk", "id": tool_call_id, "error": "Resultado já não está disponível"}
+        offset = max(0, offset)
+        chunk = text[offset:offset + WS_RESULT_CHUNK]
+        return {
+            "type": "result_chunk",
+            "id": tool_call_id,
+            "offset": offset,
+            "chunk": chunk,
+            "total": len(text),
+            "done": offset + len(chunk) >= len(text)
+        }
+    
+    async def execute_tool(self, tool_call, emit=None):
+        """Executa uma tool call e retorna (argumentos, texto do resultado)"""
+        attributes = {
+            "tool.name": tool_call.function.name,
+            "tool.args.bytes": len(tool_call.function.arguments or "")
+        }
+        with tracing.span("tool.call", attributes) as span:
+            tool_args, result_text = await self._execute_tool(tool_call, emit)
+            span.set("tool.result.bytes", len(result_text.encode("utf-8", errors="replace")))
+            return tool_args, result_text
+    
+    async def _execute_tool(self, tool_call, emit=None):
+        tool_name = tool_call.function.name
+        tool_args = json.loads(tool_call.function.arguments)
+        
+        images = []
+        streamed = 0
+        
+        async def stream_output(progress, total, message):
+            # A saída parcial para no tamanho da pré-visualização do resultado
+            nonlocal streamed
+            if message and streamed < WS_RESULT_PREVIEW:
+                streamed += len(message)
+                await emit({"type": "tool_output", "id": tool_call.id, "chunk": message})
+        
+        progress_callback = stream_output if emit else None
+        if emit:
+            await emit({
+                "type": "tool_started",
+                "id": tool_call.id,
+                "name": tool_name,
+                "args": preview_args(tool_args, WS_RESULT_PREVIEW)
+            })
+        
+        try:
+            if tool_name == "fetch_output":
+                return tool_args, self.context.fetch(**tool_args)
+            if tool_name == "request_tools":
+                return tool_args, self.router.expand(tool_args.get("groups"))
+            
+            result = await mcp_pool.call_tool(
+                tool_name, tool_args,
+                session_id=self.session_id,
+                progress_callback=progress_callback
+            )
+            
+            # Extrair texto do resultado (imagens vão só para o navegador)
+            result_text = ""
+            if hasattr(result, 'content'):
+                for content_item in result.content:
+                    if hasattr(content_item, 'text'):
+                        result_text += content_item.text
+                    elif getattr(content_item, 'data', None) and getattr(content_item, 'mimeType', None):
+                        images.append({"mimeType": content_item.mimeType, "data": content_item.data})
+                        result_text += f"\n[imagem {content_item.mimeType}, {len(content_item.data) * 3 // 4} bytes]"
+            else:
+                result_text = str(result)
+            
+        except Exception as e:
+            result_text = f"Erro ao executar {tool_name}: {str(e)}"
+        
+        if emit:
+            frame = {
+                "type": "tool_finished",
+                "id": tool_call.id,
+                "name": tool_name,
+                "args": preview_args(tool_args, WS_RESULT_PREVIEW),
+                "result": result_text[:WS_RESULT_PREVIEW],
+                "images": images
+            }
+            if len(result_text) > WS_RESULT_PREVIEW:
+                self.keep_result(tool_call.id, result_text)
+                frame["truncated"] = True
+                frame["total"] = len(result_text)
+            await emit(frame)
+        return tool_args, result_text
+    
+    async def process_message(self, user_message, emit=None):
+        """
+        Processa mensagem do usuário. Se emit for fornecido, os frames
+        (token, tool_started, tool_output, tool_finished) são enviados
+        à medida que são produzidos.
+        """
+        attributes = {"session.id": self.session_id, "message.chars": len(user_message)}
+        with tracing.span("agent.turn", attributes) as span:
+            try:
+                result = await self._process_message(user_message, emit)
+            except asyncio.CancelledError:
+                # O histórico tem de continuar válido para o próximo pedido ao LLM
+                self.context.close_tool_calls("Execução cancelada pelo usuário")
+                raise
+            # Só uma pré-visualização vai para o armazenamento de sessões
+            self.tool_log += [
+                dict(execution, args=preview_args(execution["args"], HISTORY_PREVIEW_CHARS),
+                     result=execution["result"][:HISTORY_PREVIEW_CHARS])
+                for execution in result["tool_executions"]
+            ]
+            if "error" in result:
+                span.error(result["error"])
+            span.set("turn.tool_calls", len(result["tool_executions"]))
+            span.set("turn.tool_groups", ",".join(sorted(self.router.groups)))
+            span.set("turn.tool_expansions", self.router.expansions)
+            for key, value in (result.get("tokens") or {}).items():
+                span.set(f"turn.tokens.{key}", value)
+            return result
+    
+    async def _process_message(self, user_message, emit=None):
+        # Subconjunto de ferramentas do turno (mensagem + ferramentas recentes)
+        self.router = ToolRouter(mcp_tools, user_message, self.context.messages)
+        self.context.append({"role": "user", "content": user_message})
         
         max_iterations = 10
         iteration = 0
         tool_executions = []
+        # Tokens enviados no turno (com gestão de contexto) vs. histórico completo
+        tokens = {"sent": 0, "raw": 0}
+        
+        async def emit_token(delta):
+            await emit({"type": "token", "content": delta})
+        
+        on_token = emit_token if emit else None
         
         while iteration < max_iterations:
             iteration += 1
             
             try:
-                # Chamar Groq API
-                completion = groq_client.chat.completions.create(
-                    model=MODEL,
-                    messages=self.messages,
-                    tools=mcp_tools,
-                    temperature=0.2,
-                    max_tokens=2048
-                )
+                # Chamar Groq API (assíncrono, não bloqueia outras sessões)
+                sent = self.context.fit()
+                tokens["sent"] += sent
+                tokens["raw"] += self.context.raw_tokens
                 
-                assistant_msg = completion.choices[0].message
+                llm_start = time.perf_counter()
+                outcome = "error"
+                tools = self.router.selected()
+                attributes = {
+                    "llm.iteration": iteration,
+                    "llm.messages": len(self.context.messages),
+                    "llm.tokens.sent": sent,
+                    "llm.tools": len(tools)
+                }
+                try:
+                    with tracing.span("llm.completion", attributes) as span:
+                        content, tool_calls = await llm_complete(
+                            self.context.messages,
+                            tools,
+                            session_semaphore=self.llm_semaphore,
+                            on_token=on_token
+                        )
+                        span.set("llm.tool_calls", len(tool_calls or []))
+                    outcome = "ok"
+                except asyncio.TimeoutError:
+                    outcome = "timeout"
+                    raise
+                finally:
+                    LLM_LATENCY.observe(time.perf_counter() - llm_start, outcome=outcome)
                 
                 # Processar tool calls
-                if assistant_msg.tool_calls:
-                    self.messages.append({
+                if tool_calls:
+                    self.context.append({
                         "role": "assistant",
-                        "content": assistant_msg.content or "",
+                        "content": content or "",
                         "tool_calls": [
                             {
                                 "id": tc.id,
@@ -113,67 +837,48 @@ class UserSession:
                                     "arguments": tc.function.arguments
                                 }
                             }
-                            for tc in assistant_msg.tool_calls
+                            for tc in tool_calls
                         ]
                     })
                     
-                    # Executar ferramentas
-                    for tool_call in assistant_msg.tool_calls:
-                        tool_name = tool_call.function.name
-                        tool_args = json.loads(tool_call.function.arguments)
+                    # Executar ferramentas (leituras consecutivas em paralelo)
+                    for batch in schedule_tool_calls(tool_calls):
+                        results = await asyncio.gather(
+                            *(self.execute_tool(tool_call, emit) for tool_call in batch)
+                        )
                         
-                        try:
-                            result = await mcp_session.call_tool(tool_name, tool_args)
-                            
-                            # Extrair texto do resultado
-                            result_text = ""
-                            if hasattr(result, 'content'):
-                                for content_item in result.content:
-                                    if hasattr(content_item, 'text'):
-                                        result_text += content_item.text
-                            else:
-                                result_text = str(result)
-                            
+                        # Resultados entram no histórico na ordem original dos tool_call_id
+                        for tool_call, (tool_args, result_text) in zip(batch, results):
                             tool_executions.append({
-                                "name": tool_name,
+                                "name": tool_call.function.name,
                                 "args": tool_args,
                                 "result": result_text
                             })
-                            
-                            self.messages.append({
-                                "role": "tool",
-                                "tool_call_id": tool_call.id,
-                                "content": result_text
-                            })
-                            
-                        except Exception as e:
-                            error_msg = f"Erro ao executar {tool_name}: {str(e)}"
-                            self.messages.append({
-                                "role": "tool",
-                                "tool_call_id": tool_call.id,
-                                "content": error_msg
-                            })
-                            tool_executions.append({
-                                "name": tool_name,
-                                "args": tool_args,
-                                "result": error_msg
-                            })
+                            self.context.add_tool_result(tool_call.id, result_text, tool_call.function.name)
                     
                     continue
                 
                 else:
-                    if assistant_msg.content:
-                        self.messages.append({
+                    if content:
+                        self.context.append({
                             "role": "assistant",
-                            "content": assistant_msg.content
+                            "content": content
                         })
                         return {
-                            "content": assistant_msg.content,
-                            "tool_executions": tool_executions
+                            "content": content,
+                            "tool_executions": tool_executions,
+                            "tokens": tokens
                         }
                     break
                     
+            except asyncio.TimeoutError:
+                return {
+                    "error": f"Timeout na chamada ao LLM ({LLM_TIMEOUT}s)",
+                    "tool_executions": tool_executions
+                }
             except Exception as e:
+                if self.router.recover(e):
+                    continue
                 return {
                     "error": str(e),
                     "tool_executions": tool_executions
@@ -181,84 +886,329 @@ class UserSession:
         
         return {
             "content": "Limite de iterações atingido.",
-            "tool_executions": tool_executions
+            "tool_executions": tool_executions,
+            "tokens": tokens
         }
 
 user_sessions = {}
 
+# =========================
+# ARMAZENAMENTO DE SESSÕES
+# =========================
+# memory: só no processo (uma sessão não sobrevive a reinícios nem muda de
+# worker). sqlite: arquivo WAL partilhado por todos os workers.
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")
+SESSION_DB = os.environ.get("SESSION_DB", "sessions.db")
+SESSION_MEMORY_LIMIT = 1000
+SESSION_TOOL_LOG = 200
+SESSION_ID_RE = re.compile(r"[A-Za-z0-9_-]{8,64}")
+
+class MemorySessionStore:
+    """Estados das sessões em memória (LRU)"""
+
+    def __init__(self, limit=SESSION_MEMORY_LIMIT):
+        self.limit = limit
+        self.states = OrderedDict()
+
+    async def load(self, session_id):
+        state = self.states.get(session_id)
+        if state is not None:
+            self.states.move_to_end(session_id)
+        return state
+
+    async def save(self, session_id, state):
+        # Cópia via JSON: o estado guardado não muda com a sessão em uso
+        self.states[session_id] = json.loads(json.dumps(state))
+        self.states.move_to_end(session_id)
+        while len(self.states) > self.limit:
+            self.states.popitem(last=False)
+
+class SQLiteSessionStore(SQLiteFile):
+    """Estados das sessões num arquivo SQLite (WAL), partilhado entre processos"""
+
+    def __init__(self, path):
+        super().__init__(
+            path,
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(id TEXT PRIMARY KEY, state TEXT NOT NULL, updated REAL NOT NULL);"
+        )
+
+    def _load(self, session_id):
+        row = self._db().execute("SELECT state FROM sessions WHERE id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _save(self, session_id, state):
+        db = self._db()
+        db.execute(
+            "INSERT INTO sessions (id, state, updated) VALUES (?, ?, ?) "
+            "ON CONFLICT(id) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+            (session_id, json.dumps(state, ensure_ascii=False), time.time())
+        )
+        db.commit()
+
+    async def load(self, session_id):
+        return await asyncio.to_thread(self._load, session_id)
+
+    async def save(self, session_id, state):
+        await asyncio.to_thread(self._save, session_id, state)
+
+def create_session_store():
+    if SESSION_STORE == "sqlite":
+        return SQLiteSessionStore(SESSION_DB)
+    if SESSION_STORE == "memory":
+        return MemorySessionStore()
+    raise RuntimeError(f"SESSION_STORE inválido: {SESSION_STORE} (use memory ou sqlite)")
+
+session_store = None
+
+async def save_session(session):
+    try:
+        await asyncio.to_thread(session.context.flush)
+        await session_store.save(session.session_id, session.snapshot())
+    except Exception as e:
+        print(f"⚠️  Falha ao guardar a sessão {session.session_id}: {e}")
+
+# =========================
+# SAÍDA DO WEBSOCKET (limites e backpressure)
+# =========================
+# Resultados de ferramentas vão ao navegador truncados; o resto é pedido em
+# blocos ("result_chunk") pelo ID da tool call enquanto a sessão o guardar
+WS_RESULT_PREVIEW = int(os.environ.get("WS_RESULT_PREVIEW", str(64 * 1024)))
+WS_RESULT_CHUNK = int(os.environ.get("WS_RESULT_CHUNK", str(256 * 1024)))
+WS_RESULT_STORE_CHARS = int(os.environ.get("WS_RESULT_STORE_CHARS", str(64 * 1024 * 1024)))
+# Bytes de frames por enviar a partir dos quais os produtores esperam
+WS_SEND_BUFFER = int(os.environ.get("WS_SEND_BUFFER", str(1024 * 1024)))
+# permessage-deflate
+WS_COMPRESS = os.environ.get("WS_COMPRESS", "on") == "on"
+# Com o cliente atrasado estes frames são omitidos em vez de esperar
+# (o resultado completo chega depois em tool_finished)
+DROPPABLE_FRAMES = {"tool_output"}
+
+def preview_args(tool_args, limit):
+    """Argumentos de uma tool call para exibição: acima do limite só o início do JSON"""
+    text = json.dumps(tool_args, ensure_ascii=False)
+    if len(text) <= limit:
+        return tool_args
+    return {"truncated": f"{text[:limit]}... [{len(text)} caracteres]"}
+
+class FrameSender:
+    """
+    Fila de saída de um WebSocket, limitada em bytes. Um único writer envia
+    os frames por ordem e o send da aiohttp espera o drain do transporte:
+    com um cliente lento a fila enche e send() pausa os produtores (tokens
+    do LLM, resultados). Frames descartáveis nunca esperam, para não
+    bloquear a sessão MCP partilhada que entrega o progresso das ferramentas.
+    """
+
+    def __init__(self, ws, limit=WS_SEND_BUFFER):
+        self.ws = ws
+        self.limit = limit
+        self.queue = deque()
+        self.size = 0
+        self.dropped = 0
+        self.closed = False
+        self._pending = asyncio.Event()
+        self._space = asyncio.Event()
+        self._space.set()
+        self._task = asyncio.create_task(self._run())
+
+    async def send(self, frame):
+        """Enfileira um frame (dict ou JSON já serializado)"""
+        droppable = isinstance(frame, dict) and frame.get("type") in DROPPABLE_FRAMES
+        if self.closed and droppable:
+            # Progresso de um cliente que já saiu: nada a fazer
+            return
+        data = frame if isinstance(frame, str) else json.dumps(frame, ensure_ascii=False)
+        if self.size >= self.limit and droppable:
+            self.dropped += len(data)
+            WS_DROPPED_BYTES.inc(len(data))
+            return
+        while self.size >= self.limit and not self.closed:
+            self._space.clear()
+            await self._space.wait()
+        if self.closed:
+            raise ConnectionResetError("WebSocket fechado")
+        self.queue.append(data)
+        self.size += len(data)
+        self._pending.set()
+
+    async def _run(self):
+        try:
+            while True:
+                await self._pending.wait()
+                self._pending.clear()
+                while self.queue:
+                    data = self.queue[0]
+                    await self.ws.send_str(data)
+                    self.queue.popleft()
+                    self.size -= len(data)
+                    if self.size < self.limit:
+                        self._space.set()
+        except Exception as e:
+            if not self.ws.closed:
+                print(f"⚠️  Falha ao enviar frame: {e}")
+        finally:
+            # Acorda os produtores em espera; os próximos send() falham
+            self.closed = True
+            self.queue.clear()
+            self.size = 0
+            self._space.set()
+
+    async def close(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+# =========================
 # WEBSOCKET HANDLER
 # =========================
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    ws = web.WebSocketResponse(compress=WS_COMPRESS)
     await ws.prepare(request)
+    # Todos os frames passam pela fila com limite (ordem e backpressure)
+    sender = FrameSender(ws)
     
-    session_id = str(id(ws))
+    global active_websockets
+    # O cliente reenvia o seu ID para retomar a conversa em qualquer worker
+    session_id = request.query.get("session", "")
+    if not SESSION_ID_RE.fullmatch(session_id):
+        session_id = uuid.uuid4().hex
     session = UserSession(session_id)
+    state = await session_store.load(session_id)
+    if state:
+        session.restore(state)
+    if conversation_log:
+        # Só o fim da conversa (dentro do orçamento) é lido do log
+        await asyncio.to_thread(session.context.load_tail)
+    resumed = len(session.messages) > 1
     user_sessions[session_id] = session
+    active_websockets += 1
+    WS_CONNECTIONS.inc()
     
-    print(f"✓ Cliente conectado: {session_id}")
+    print(f"✓ Cliente conectado: {session_id}{' (retomada)' if resumed else ''} [pid {os.getpid()}]")
     
-    try:
-        # Enviar lista de ferramentas
-        tools_list = [
-            {
-                "name": tool["function"]["name"],
-                "description": tool["function"]["description"]
-            }
-            for tool in mcp_tools
-        ]
+    turn = None
+    
+    async def run_turn(user_message):
+        # Time-to-first-byte: do recebimento até o primeiro frame enviado
+        received_at = time.perf_counter()
+        first_frame_at = None
         
-        await ws.send_json({
-            "type": "tools",
-            "tools": tools_list
+        async def emit(frame):
+            nonlocal first_frame_at
+            if first_frame_at is None:
+                first_frame_at = time.perf_counter()
+            await sender.send(frame)
+        
+        # Processar mensagem, enviando frames à medida que são produzidos
+        try:
+            response = await session.process_message(user_message, emit=emit)
+        except asyncio.CancelledError:
+            # Cancelamento propagado ao LLM e às ferramentas (notifications/cancelled)
+            await save_session(session)
+            if not ws.closed:
+                await sender.send({"type": "cancelled", "message": "Execução interrompida"})
+            print(f"⏹️  {session_id}: turno cancelado")
+            return
+        except Exception as e:
+            print(f"❌ Erro no turno de {session_id}: {e}")
+            return
+        await save_session(session)
+        
+        finished_at = time.perf_counter()
+        TURN_LATENCY.observe(finished_at - received_at)
+        TURN_TTFB.observe((first_frame_at or finished_at) - received_at)
+        ttfb_ms = round(1000 * ((first_frame_at or finished_at) - received_at), 1)
+        total_ms = round(1000 * (finished_at - received_at), 1)
+        tokens = response.get("tokens", {})
+        print(f"⏱️  {session_id}: TTFB {ttfb_ms} ms, total {total_ms} ms, "
+              f"tokens enviados {tokens.get('sent', 0)} (sem gestão: {tokens.get('raw', 0)})")
+        
+        if "error" in response:
+            await sender.send({
+                "type": "error",
+                "message": response["error"]
+            })
+        else:
+            # Resposta final (o conteúdo já foi enviado em tokens)
+            await sender.send({
+                "type": "response",
+                "content": response.get("content", ""),
+                "ttfb_ms": ttfb_ms,
+                "total_ms": total_ms,
+                "tokens": tokens
+            })
+    
+    try:
+        history = sum(1 for m in session.messages if m["role"] in ("user", "assistant") and m.get("content"))
+        await sender.send({
+            "type": "session",
+            "session_id": session_id,
+            "resumed": resumed,
+            "history": bool(conversation_log),
+            "messages": history
         })
         
-        await ws.send_json({
+        # Enviar lista de ferramentas (serializada uma única vez no arranque)
+        await sender.send(tools_frame)
+        
+        await sender.send({
             "type": "status",
-            "message": "Conectado ao servidor MCP"
+            "message": f"Conversa retomada ({history} mensagens)" if resumed else "Conectado ao servidor MCP"
         })
         
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
                 try:
                     data = json.loads(msg.data)
+                    WS_MESSAGES.inc(type=str(data.get("type")))
                     
                     if data.get("type") == "message":
-                        user_message = data.get("content")
-                        
-                        # Processar mensagem
-                        response = await session.process_message(user_message)
-                        
-                        if "error" in response:
-                            await ws.send_json({
+                        if turn and not turn.done():
+                            await sender.send({
                                 "type": "error",
-                                "message": response["error"]
-                            })
-                        else:
-                            # Enviar execuções de ferramentas
-                            for tool_exec in response.get("tool_executions", []):
-                                await ws.send_json({
-                                    "type": "tool_execution",
-                                    "name": tool_exec["name"],
-                                    "args": tool_exec["args"],
-                                    "result": tool_exec["result"]
-                                })
-                            
-                            # Enviar resposta final
-                            await ws.send_json({
-                                "type": "response",
-                                "content": response.get("content", "")
+                                "message": "Ainda há um pedido em execução; aguarde ou pare-o"
                             })
+                            continue
+                        # O turno corre numa task para que "stop" possa interrompê-lo
+                        turn = asyncio.create_task(run_turn(data.get("content")))
+                    
+                    elif data.get("type") == "stop":
+                        if turn and not turn.done():
+                            turn.cancel()
+                    
+                    elif data.get("type") == "result_chunk":
+                        # "Carregar mais" de um resultado truncado
+                        offset = data.get("offset")
+                        await sender.send(session.result_chunk(data.get("id"), offset if isinstance(offset, int) else 0))
+                    
+                    elif data.get("type") == "history" and conversation_log:
+                        # Página de mensagens anteriores a "before" (rolagem para cima)
+                        before = data.get("before")
+                        try:
+                            await asyncio.to_thread(session.context.flush)
+                        except Exception as e:
+                            # Os eventos continuam pendentes; a página mostra o já gravado
+                            print(f"⚠️  Falha ao gravar o histórico de {session_id}: {e}")
+                        items, has_more = await asyncio.to_thread(
+                            conversation_log.page, session_id,
+                            before if isinstance(before, int) else None
+                        )
+                        await sender.send({"type": "history", "items": items, "has_more": has_more})
                     
                     elif data.get("type") == "clear":
-                        session.messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-                        await ws.send_json({
+                        if turn and not turn.done():
+                            turn.cancel()
+                            await asyncio.gather(turn, return_exceptions=True)
+                        session.context.clear()
+                        session.tool_log = []
+                        await save_session(session)
+                        await sender.send({
                             "type": "status",
                             "message": "Histórico limpo"
                         })
                 
                 except json.JSONDecodeError:
-                    await ws.send_json({
+                    await sender.send({
                         "type": "error",
                         "message": "Formato de mensagem inválido"
                     })
@@ -270,8 +1220,21 @@ async def websocket_handler(request):
         print(f"❌ Erro no handler WebSocket: {e}")
     
     finally:
-        if session_id in user_sessions:
+        # Cliente desconectado: interrompe o turno em curso (e as ferramentas)
+        if turn and not turn.done():
+            turn.cancel()
+            await asyncio.gather(turn, return_exceptions=True)
+        await sender.close()
+        if conversation_log:
+            try:
+                await asyncio.to_thread(session.context.flush)
+            except Exception as e:
+                print(f"⚠️  Falha ao gravar o histórico de {session_id}: {e}")
+        active_websockets -= 1
+        if user_sessions.get(session_id) is session:
             del user_sessions[session_id]
+        if mcp_pool:
+            mcp_pool.release(session_id)
         print(f"✗ Cliente desconectado: {session_id}")
     
     return ws
@@ -292,35 +1255,106 @@ async def health_handler(request):
     """Endpoint de health check"""
     return web.json_response({
         "status": "ok",
+        "worker_pid": os.getpid(),
+        "session_store": SESSION_STORE,
         "sessions": len(user_sessions),
-        "mcp_connected": mcp_session is not None,
-        "tools_available": len(mcp_tools)
+        "mcp_connected": bool(mcp_pool) and any(w.alive for w in mcp_pool.workers),
+        "tools_available": len(mcp_tools),
+        "mcp_workers": mcp_pool.stats() if mcp_pool else []
     })
 
+# Tempos medidos dentro dos servidores MCP: recolhidos em segundo plano, o
+# scrape do /metrics só lê o último instantâneo
+SERVER_METRICS_INTERVAL = float(os.environ.get("SERVER_METRICS_INTERVAL", "15"))
+# {rótulos do servidor: {ferramenta: {"sum", "count"}}}
+server_tool_stats = {}
+
+async def server_tool_metrics(worker):
+    """Tempos de execução medidos dentro do servidor MCP (sem transporte); None se indisponível"""
+    if not worker.alive or worker.in_flight > 0:
+        return None
+    try:
+        result = await asyncio.wait_for(worker.session.call_tool("server_metrics", {}), timeout=1)
+        return json.loads("".join(c.text for c in result.content if hasattr(c, "text")))
+    except Exception:
+        return None
+
+async def collect_server_metrics():
+    """
+    Atualiza server_tool_stats a cada SERVER_METRICS_INTERVAL. Em stdio cada
+    worker tem o seu servidor; em http/unix todos partilham um só, consultado
+    uma vez (senão os contadores seriam somados por worker).
+    """
+    while True:
+        workers = mcp_pool.workers if mcp_pool else []
+        if MCP_TRANSPORT == "stdio":
+            targets = [({"worker": w.index}, w) for w in workers]
+        else:
+            endpoint = MCP_SOCKET if MCP_TRANSPORT == "unix" else MCP_URL
+            idle = sorted((w for w in workers if w.alive), key=lambda w: w.in_flight)
+            targets = [({"endpoint": endpoint}, idle[0])] if idle else []
+        results = await asyncio.gather(*(server_tool_metrics(w) for _, w in targets))
+        for (labels, _), stats in zip(targets, results):
+            # Worker ocupado ou sem resposta: mantém o instantâneo anterior
+            if stats is not None:
+                server_tool_stats[tuple(labels.items())] = stats
+        await asyncio.sleep(SERVER_METRICS_INTERVAL)
+
+async def metrics_handler(request):
+    """Métricas no formato de texto do Prometheus"""
+    lines = []
+    for metric in (LLM_LATENCY, LLM_TOKENS, LLM_CACHE_REQUESTS, TOOL_LATENCY, TURN_LATENCY, TURN_TTFB, WS_DROPPED_BYTES,
+                   WS_CONNECTIONS, WS_MESSAGES):
+        lines += metric.render()
+    lines += gauge("agent_active_websockets", "WebSockets abertos", [({}, active_websockets)])
+    lines += gauge("agent_sessions", "Sessões de usuário ativas", [({}, len(user_sessions))])
+    lines += gauge("agent_event_loop_lag_seconds", "Atraso do event loop", [({}, event_loop_lag)])
+    lines += gauge("process_resident_memory_bytes", "Memória residente do processo", [({}, process_rss_bytes())])
+    
+    workers = mcp_pool.workers if mcp_pool else []
+    lines += gauge("agent_mcp_queue_depth", "Chamadas em andamento por worker MCP",
+                   [({"worker": w.index}, w.in_flight) for w in workers])
+    lines += gauge("agent_mcp_worker_up", "Worker MCP ativo", [({"worker": w.index}, int(w.alive)) for w in workers])
+    
+    exec_sum, exec_count = [], []
+    for server, stats in list(server_tool_stats.items()):
+        for tool, values in stats.items():
+            labels = {**dict(server), "tool": tool}
+            exec_sum.append((labels, values["sum"]))
+            exec_count.append((labels, values["count"]))
+    lines += gauge("agent_mcp_server_tool_seconds_total", "Tempo de execução no servidor MCP",
+                   exec_sum, kind="counter")
+    lines += gauge("agent_mcp_server_tool_calls_total", "Execuções no servidor MCP",
+                   exec_count, kind="counter")
+    return web.Response(text="\n".join(lines) + "\n", content_type="text/plain")
+
 # LIFECYCLE
 async def on_startup(app):
     """Executado ao iniciar o servidor"""
+    global session_store, conversation_log
+    session_store = create_session_store()
+    if CONVERSATION_DB:
+        conversation_log = ConversationLog(CONVERSATION_DB)
     try:
         await initialize_mcp()
     except Exception as e:
         print(f"❌ Falha ao inicializar MCP: {e}")
         raise
+    app["loop_monitor"] = asyncio.create_task(monitor_event_loop())
+    app["server_metrics"] = asyncio.create_task(collect_server_metrics())
 
 async def on_cleanup(app):
     """Executado ao parar o servidor"""
-    global mcp_client_context, mcp_session
     print("\n🛑 Encerrando servidor...")
     
-    if mcp_session:
-        try:
-            await mcp_session.__aexit__(None, None, None)
-        except:
-            pass
+    for task in ("loop_monitor", "server_metrics"):
+        if task in app:
+            app[task].cancel()
     
-    if mcp_client_context:
+    if mcp_pool:
         try:
-            await mcp_client_context.__aexit__(None, None, None)
-        except:
+            await mcp_pool.stop()
+        except Exception:
             pass
 
 def create_app():
@@ -332,24 +1366,80 @@ def create_app():
     
     app.router.add_get('/', index_handler)
     app.router.add_get('/health', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
     app.router.add_get('/ws', websocket_handler)
     
     return app
 
+# =========================
+# MULTIPROCESSO (prefork com SO_REUSEPORT)
+# =========================
+WEB_WORKERS = int(os.environ.get("WEB_WORKERS", "1"))
+
+def serve(reuse_port=False):
+    # Cada worker cria a sua aplicação, loop e pool MCP; o kernel distribui
+    # as ligações entre os sockets com SO_REUSEPORT
+    web.run_app(create_app(), host='0.0.0.0', port=8080, print=None, reuse_port=reuse_port)
+
+def _terminate(signum, frame):
+    raise KeyboardInterrupt
+
+def run_workers(count):
+    """Processo mestre: inicia os workers e reinicia os que terminarem"""
+    signal.signal(signal.SIGTERM, _terminate)
+    workers = {}
+    
+    def spawn(index):
+        process = multiprocessing.Process(target=serve, args=(True,), name=f"web-worker-{index}")
+        process.start()
+        workers[index] = process
+    
+    for index in range(count):
+        spawn(index)
+    try:
+        while True:
+            time.sleep(1)
+            for index, process in list(workers.items()):
+                if not process.is_alive():
+                    print(f"♻️  Worker web {index} (pid {process.pid}) terminou "
+                          f"com código {process.exitcode}; reiniciando")
+                    spawn(index)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+        for process in workers.values():
+            process.join(10)
+
 def main():
-    if not os.environ.get("GROQ_API_KEY"):
+    if not os.environ.get("GROQ_API_KEY") and LLM_CACHE != "replay":
         print("Erro: GROQ_API_KEY não configurada")
         print("Execute: export GROQ_API_KEY='sua_chave_aqui'")
         exit(1)
     
+    workers = WEB_WORKERS
+    if workers > 1 and not hasattr(socket, "SO_REUSEPORT"):
+        print("⚠️  SO_REUSEPORT não suportado nesta plataforma: usando 1 worker")
+        workers = 1
+    
     print("🚀 Iniciando servidor web...")
     print("   Interface: http://localhost:8080")
     print("   WebSocket: ws://localhost:8080/ws")
     print("   Health: http://localhost:8080/health")
+    print(f"   Workers: {workers} · sessões: {SESSION_STORE}")
+    if workers > 1 and SESSION_STORE == "memory":
+        print("⚠️  SESSION_STORE=memory: uma conversa só é retomada se voltar ao mesmo worker")
+    if workers > 1 and MCP_TRANSPORT == "stdio":
+        print(f"   Dica: cada worker inicia {MCP_POOL_SIZE} servidores MCP; "
+              f"MCP_TRANSPORT=unix partilha um único servidor")
     print("\nPressione Ctrl+C para parar\n")
     
-    app = create_app()
-    web.run_app(app, host='0.0.0.0', port=8080, print=None)
+    if workers == 1:
+        serve()
+    else:
+        run_workers(workers)
 
 if __name__ == "__main__":
     main()
@@ -1,8 +1,25 @@
 #include <pybind11/pybind11.h>
+#include <pybind11/stl.h>
 #include <cstdio>
 #include <memory>
 #include <array>
 #include <string>
+#include <vector>
+#include <chrono>
+#include <stdexcept>
+#include <algorithm>
+
+#ifndef _WIN32
+    #include <spawn.h>
+    #include <poll.h>
+    #include <fcntl.h>
+    #include <unistd.h>
+    #include <signal.h>
+    #include <cerrno>
+    #include <cstring>
+    #include <sys/wait.h>
+    extern char **environ;
+#endif
 
 namespace py = pybind11;
 
@@ -32,7 +49,7 @@ std::string cmd(const std::string &command)
 
 void entryponit()
 {
-	
+
 }
 
 void run(const std::string &command)
@@ -40,10 +57,209 @@ void run(const std::string &command)
    output_first = cmd(command);
 }
 
+/*
+//	executor nativo: posix_spawn sem shell, pipes drenados com poll
+*/
+struct ExecResult
+{
+	std::string	out;
+	std::string	err;
+	int			exit_code = -1;
+	double		elapsed_ms = 0.0;
+	bool		timed_out = false;
+	size_t		dropped = 0;
+};
+
+#ifndef _WIN32
+static const size_t	READ_CHUNK = 64 * 1024;
+// Intervalo entre waitpid(WNOHANG) enquanto o filho não termina
+static const useconds_t	REAP_INTERVAL_US = 5000;
+
+// pipe com FD_CLOEXEC (pipe2 só existe no Linux)
+static int open_pipe(int fds[2])
+{
+#ifdef __linux__
+	return pipe2(fds, O_CLOEXEC);
+#else
+	if (pipe(fds) != 0)
+		return -1;
+	fcntl(fds[0], F_SETFD, FD_CLOEXEC);
+	fcntl(fds[1], F_SETFD, FD_CLOEXEC);
+	return 0;
+#endif
+}
+
+// Mantém apenas os últimos max_output bytes (descarte amortizado)
+static void append_bounded(std::string &buf, const char *data, size_t n, size_t max_output, size_t &dropped)
+{
+	buf.append(data, n);
+	if (max_output && buf.size() > 2 * max_output)
+	{
+		size_t excess = buf.size() - max_output;
+		buf.erase(0, excess);
+		dropped += excess;
+	}
+}
+
+static void trim_bounded(std::string &buf, size_t max_output, size_t &dropped)
+{
+	if (max_output && buf.size() > max_output)
+	{
+		size_t excess = buf.size() - max_output;
+		buf.erase(0, excess);
+		dropped += excess;
+	}
+}
+
+ExecResult execute(const std::vector<std::string> &argv, double timeout, size_t max_output)
+{
+	if (argv.empty())
+		throw std::invalid_argument("argv vazio");
+
+	ExecResult	res;
+	auto		start = std::chrono::steady_clock::now();
+	int			out_pipe[2];
+	int			err_pipe[2];
+
+	if (open_pipe(out_pipe) != 0)
+		throw std::runtime_error(std::string("pipe: ") + strerror(errno));
+	if (open_pipe(err_pipe) != 0)
+	{
+		close(out_pipe[0]);
+		close(out_pipe[1]);
+		throw std::runtime_error(std::string("pipe: ") + strerror(errno));
+	}
+
+	posix_spawn_file_actions_t	actions;
+	posix_spawn_file_actions_init(&actions);
+	posix_spawn_file_actions_addopen(&actions, STDIN_FILENO, "/dev/null", O_RDONLY, 0);
+	posix_spawn_file_actions_adddup2(&actions, out_pipe[1], STDOUT_FILENO);
+	posix_spawn_file_actions_adddup2(&actions, err_pipe[1], STDERR_FILENO);
+
+	std::vector<char *>	args;
+	for (const auto &arg : argv)
+		args.push_back(const_cast<char *>(arg.c_str()));
+	args.push_back(nullptr);
+
+	// Grupo de processos próprio: no timeout o kill chega também aos netos
+	posix_spawnattr_t	attr;
+	posix_spawnattr_init(&attr);
+	posix_spawnattr_setflags(&attr, POSIX_SPAWN_SETPGROUP);
+	posix_spawnattr_setpgroup(&attr, 0);
+
+	pid_t	pid;
+	int		rc = posix_spawnp(&pid, args[0], &actions, &attr, args.data(), environ);
+	posix_spawn_file_actions_destroy(&actions);
+	posix_spawnattr_destroy(&attr);
+	close(out_pipe[1]);
+	close(err_pipe[1]);
+	if (rc != 0)
+	{
+		close(out_pipe[0]);
+		close(err_pipe[0]);
+		throw std::runtime_error(std::string("posix_spawn: ") + strerror(rc));
+	}
+
+	if (max_output)
+	{
+		res.out.reserve(std::min(max_output, READ_CHUNK));
+		res.err.reserve(std::min(max_output, READ_CHUNK));
+	}
+	std::vector<char>	chunk(READ_CHUNK);
+	struct pollfd		fds[2] = {{out_pipe[0], POLLIN, 0}, {err_pipe[0], POLLIN, 0}};
+	int					open_fds = 2;
+
+	while (open_fds > 0)
+	{
+		int wait_ms = -1;
+		if (timeout > 0)
+		{
+			double elapsed = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+			if (elapsed >= timeout)
+			{
+				res.timed_out = true;
+				killpg(pid, SIGKILL);
+				break;
+			}
+			wait_ms = static_cast<int>((timeout - elapsed) * 1000) + 1;
+		}
+		int ready = poll(fds, 2, wait_ms);
+		if (ready < 0)
+		{
+			if (errno == EINTR)
+				continue;
+			killpg(pid, SIGKILL);
+			break;
+		}
+		for (int i = 0; i < 2; i++)
+		{
+			if (fds[i].fd < 0 || !(fds[i].revents & (POLLIN | POLLHUP | POLLERR)))
+				continue;
+			ssize_t n = read(fds[i].fd, chunk.data(), chunk.size());
+			if (n > 0)
+				append_bounded(i == 0 ? res.out : res.err, chunk.data(), n, max_output, res.dropped);
+			else if (n == 0 || errno != EINTR)
+			{
+				close(fds[i].fd);
+				fds[i].fd = -1;
+				open_fds--;
+			}
+		}
+	}
+	for (auto &fd : fds)
+		if (fd.fd >= 0)
+			close(fd.fd);
+
+	// Pipes fechados não significam fim do processo (ex: cmd > log 2>&1):
+	// o prazo continua a valer até o waitpid
+	int status = 0;
+	while (!res.timed_out)
+	{
+		pid_t reaped = waitpid(pid, &status, WNOHANG);
+		if (reaped == pid || (reaped < 0 && errno != EINTR))
+			break;
+		double elapsed = std::chrono::duration<double>(std::chrono::steady_clock::now() - start).count();
+		if (timeout > 0 && elapsed >= timeout)
+		{
+			res.timed_out = true;
+			killpg(pid, SIGKILL);
+			break;
+		}
+		usleep(REAP_INTERVAL_US);
+	}
+	if (res.timed_out)
+		while (waitpid(pid, &status, 0) < 0 && errno == EINTR)
+			;
+	if (WIFEXITED(status))
+		res.exit_code = WEXITSTATUS(status);
+	else if (WIFSIGNALED(status))
+		res.exit_code = -WTERMSIG(status);
+
+	trim_bounded(res.out, max_output, res.dropped);
+	trim_bounded(res.err, max_output, res.dropped);
+	res.elapsed_ms = std::chrono::duration<double, std::milli>(std::chrono::steady_clock::now() - start).count();
+	return (res);
+}
+#endif
+
 PYBIND11_MODULE(libexec, e)
 {
     e.def("cmd", &cmd, "Executa um comando do sistema e retorna o stdout");
     e.def("entryponit", &entryponit);
     e.def("run", &run);
-}
 
+    py::class_<ExecResult>(e, "ExecResult")
+        .def_property_readonly("stdout", [](const ExecResult &r) { return py::bytes(r.out); })
+        .def_property_readonly("stderr", [](const ExecResult &r) { return py::bytes(r.err); })
+        .def_readonly("exit_code", &ExecResult::exit_code)
+        .def_readonly("elapsed_ms", &ExecResult::elapsed_ms)
+        .def_readonly("timed_out", &ExecResult::timed_out)
+        .def_readonly("dropped", &ExecResult::dropped);
+
+#ifndef _WIN32
+    e.def("execute", &execute,
+          "Executa argv sem shell (posix_spawn) e retorna stdout, stderr, exit code e tempo",
+          py::arg("argv"), py::arg("timeout") = 0.0, py::arg("max_output") = 0,
+          py::call_guard<py::gil_scoped_release>());
+#endif
+}
@@ -1,7 +1,24 @@
 import os
+import time
+import uuid
+import signal
+import io
+import re
+import json
+import shlex
+import mmap
+import bisect
+import hashlib
+import inspect
+import tempfile
+import fnmatch
+import functools
+import importlib.util
+import asyncio
 import subprocess
 import logging
-from typing import List
+from collections import OrderedDict
+from typing import Dict, List
 
 # =========================
 # CONFIGURAR DISPLAY ANTES DE IMPORTAR PYAUTOGUI
@@ -9,48 +26,563 @@ from typing import List
 if 'DISPLAY' not in os.environ:
     os.environ['DISPLAY'] = ':0'
 
-# Importação condicional do pyautogui
-try:
-    import pyautogui
-    pyautogui.FAILSAFE = True
-    PYAUTOGUI_AVAILABLE = True
-except Exception as e:
-    PYAUTOGUI_AVAILABLE = False
-    print(f"⚠️  PyAutoGUI não disponível: {e}")
+# O pyautogui (com PIL, Xlib, ...) pesa no arranque de cada servidor: as
+# ferramentas de GUI são registradas só pela assinatura e o módulo é
+# importado na primeira chamada
+PYAUTOGUI_AVAILABLE = importlib.util.find_spec("pyautogui") is not None
+pyautogui = None
+
+def _gui():
+    """Importa o pyautogui na primeira utilização"""
+    global pyautogui
+    if pyautogui is None:
+        try:
+            import pyautogui as module
+        except Exception as e:
+            raise RuntimeError(f"PyAutoGUI não disponível: {e}") from e
+        module.FAILSAFE = True
+        pyautogui = module
+    return pyautogui
 
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import FastMCP, Context, Image as MCPImage
+import tracing
 
 # =========================
 # CONFIGURAÇÕES GERAIS
 # =========================
 logging.basicConfig(level=logging.INFO)
-app = FastMCP("mcp-devops-pc-agent")
+
+# Tempo de execução por ferramenta medido dentro do servidor, para separar
+# o tempo de execução do tempo de transporte visto pelo cliente
+tool_timings = {}
+
+class TimedFastMCP(FastMCP):
+    async def call_tool(self, name, *args, **kwargs):
+        start = time.perf_counter()
+        failed = True
+        try:
+            with tracing.span("mcp.tool", {"tool.name": name}):
+                result = await super().call_tool(name, *args, **kwargs)
+            failed = False
+            return result
+        finally:
+            stats = tool_timings.setdefault(name, {"count": 0, "errors": 0, "sum": 0.0, "max": 0.0})
+            elapsed = time.perf_counter() - start
+            stats["count"] += 1
+            stats["errors"] += int(failed)
+            stats["sum"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+
+app = TimedFastMCP("mcp-devops-pc-agent")
+
+# =========================
+# CACHE DE RESULTADOS (ferramentas idempotentes)
+# =========================
+RESULT_CACHE_ENABLED = os.environ.get("MCP_RESULT_CACHE", "1") != "0"
+# Limite em bytes dos resultados guardados; resultados maiores que
+# RESULT_CACHE_MAX_ITEM não entram (ex: read_file de um arquivo enorme)
+RESULT_CACHE_BYTES = int(os.environ.get("MCP_RESULT_CACHE_BYTES", str(32 * 1024 * 1024)))
+RESULT_CACHE_MAX_ITEM = int(os.environ.get("MCP_RESULT_CACHE_MAX_ITEM", str(1024 * 1024)))
+
+# TTL em segundos por ferramenta
+CACHE_TTLS = {
+    "pwd": 300,
+    "system_info": 300,
+    "list_dir": 10,
+    "read_file": 30,
+    "read_bytes": 30,
+    "git_status": 2,
+    "git_diff": 2,
+    "git_log": 30,
+}
+
+def _stat_key(path: str):
+    try:
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+    except OSError:
+        return None
+
+def _git_dir():
+    path = os.getcwd()
+    while True:
+        candidate = os.path.join(path, ".git")
+        if os.path.exists(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def _git_state(args=None):
+    """Assinatura do índice/HEAD do git: muda em add, commit, checkout, etc."""
+    git_dir = _git_dir()
+    if git_dir is None:
+        return None
+    return tuple(_stat_key(os.path.join(git_dir, name)) for name in ("index", "HEAD", "logs/HEAD"))
+
+def _path_state(args):
+    return _stat_key(args.get("path", "."))
+
+class ResultCache:
+    """
+    Cache de resultados endereçado pelo hash (ferramenta + argumentos).
+    Cada entrada guarda uma assinatura (mtime/tamanho, estado do git) que é
+    revalidada a cada acesso, além do TTL da ferramenta.
+    """
+
+    def __init__(self, max_bytes: int = RESULT_CACHE_BYTES, max_item: int = RESULT_CACHE_MAX_ITEM):
+        self.max_bytes = max_bytes
+        self.max_item = max_item
+        self.entries = OrderedDict()
+        self.size = 0
+        self.skipped = 0
+        self.hits = {}
+        self.misses = {}
+        self.invalidations = 0
+
+    @staticmethod
+    def key(tool: str, args: dict) -> str:
+        payload = json.dumps([tool, args], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def result_size(result) -> int:
+        if isinstance(result, (bytes, bytearray)):
+            return len(result)
+        if isinstance(result, str):
+            return len(result.encode("utf-8", errors="replace"))
+        return len(json.dumps(result, default=str).encode("utf-8"))
+
+    def _remove(self, key):
+        self.size -= self.entries.pop(key)["size"]
+
+    def get(self, tool: str, args: dict, state):
+        key = self.key(tool, args)
+        entry = self.entries.get(key)
+        if entry is not None and entry["expires"] > time.monotonic() and entry["state"] == state:
+            self.entries.move_to_end(key)
+            self.hits[tool] = self.hits.get(tool, 0) + 1
+            return True, entry["result"]
+        if entry is not None:
+            self._remove(key)
+        self.misses[tool] = self.misses.get(tool, 0) + 1
+        return False, None
+
+    def put(self, tool: str, args: dict, state, result):
+        key = self.key(tool, args)
+        if key in self.entries:
+            self._remove(key)
+        size = self.result_size(result)
+        if size > self.max_item:
+            self.skipped += 1
+            return
+        self.entries[key] = {
+            "tool": tool,
+            "path": os.path.realpath(args["path"]) if "path" in args else None,
+            "state": state,
+            "expires": time.monotonic() + CACHE_TTLS.get(tool, 0),
+            "result": result,
+            "size": size,
+        }
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def invalidate(self, tools=None, path: str = None):
+        """Remove entradas das ferramentas dadas e/ou ligadas ao caminho (e à pasta pai)"""
+        targets = set()
+        if path is not None:
+            real = os.path.realpath(path)
+            targets = {real, os.path.dirname(real)}
+        for key, entry in list(self.entries.items()):
+            if (tools is not None and entry["tool"] in tools) or entry["path"] in targets:
+                self._remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        self.invalidations += len(self.entries)
+        self.entries.clear()
+        self.size = 0
+
+result_cache = ResultCache()
+
+# Servidores stdio irmãos (pool do web_server): cada processo tem o seu cache
+# e as escritas feitas por outro não o invalidam. O estado do git só cobre o
+# índice e o HEAD, então as ferramentas que leem a árvore de trabalho não
+# são guardadas quando há mais de um servidor.
+PEER_SERVERS = int(os.environ.get("MCP_PEER_SERVERS", "1"))
+WORKTREE_TOOLS = {"git_status", "git_diff"}
+
+def cached_tool(state=None):
+    """
+    Decorador para ferramentas idempotentes: reutiliza o resultado enquanto
+    o TTL não expirar e a assinatura `state(args)` não mudar
+    """
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not RESULT_CACHE_ENABLED or (PEER_SERVERS > 1 and fn.__name__ in WORKTREE_TOOLS):
+                return fn(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            current = state(arguments) if state else None
+            hit, result = result_cache.get(fn.__name__, arguments, current)
+            if hit:
+                return result
+            result = fn(*args, **kwargs)
+            result_cache.put(fn.__name__, arguments, current, result)
+            return result
+        return wrapper
+    return decorator
+
+GIT_TOOLS = {"git_status", "git_diff", "git_log"}
 
 # =========================
 # DEVOPS / SISTEMA
 # =========================
 @app.tool()
+@cached_tool()
 def pwd() -> str:
     """Retorna o diretório atual"""
     return os.getcwd()
 
 @app.tool()
+@cached_tool(_path_state)
 def list_dir(path: str = ".") -> List[str]:
     """Lista arquivos e pastas"""
     return os.listdir(path)
 
+# =========================
+# LEITURA DE ARQUIVOS (mmap + índice de linhas)
+# =========================
+MAX_READ_BYTES = int(os.environ.get("MCP_MAX_READ_BYTES", str(512 * 1024)))
+LINE_INDEX_BLOCK = 1 << 20
+LINE_INDEX_CACHE_SIZE = 64
+
+class LineIndex:
+    """
+    Índice esparso de linhas: pares (linha, offset) a cada ~LINE_INDEX_BLOCK
+    bytes, estendido sob demanda à medida que linhas mais distantes são lidas.
+    """
+
+    def __init__(self, mtime_ns: int, size: int):
+        self.mtime_ns = mtime_ns
+        self.size = size
+        self.lines = [1]
+        self.offsets = [0]
+
+    def offset_of(self, mm, line: int):
+        """Offset do início da linha (1-based) ou None se estiver além do fim"""
+        i = bisect.bisect_right(self.lines, line) - 1
+        current, pos = self.lines[i], self.offsets[i]
+        # Avança bloco a bloco, contando quebras de linha em C
+        while True:
+            block_end = mm.rfind(b"\n", pos, min(self.size, pos + LINE_INDEX_BLOCK)) + 1
+            if block_end <= pos:
+                break
+            count = mm[pos:block_end].count(b"\n")
+            if current + count > line:
+                break
+            current += count
+            pos = block_end
+            if current > self.lines[-1]:
+                self.lines.append(current)
+                self.offsets.append(pos)
+        while current < line:
+            nl = mm.find(b"\n", pos)
+            if nl == -1:
+                return None
+            pos = nl + 1
+            current += 1
+        return pos if pos < self.size else None
+
+_line_indexes = OrderedDict()
+
+def _line_index(path: str, st) -> LineIndex:
+    """Índice em cache, invalidado quando mtime ou tamanho mudam"""
+    key = os.path.realpath(path)
+    index = _line_indexes.get(key)
+    if index is None or index.mtime_ns != st.st_mtime_ns or index.size != st.st_size:
+        index = LineIndex(st.st_mtime_ns, st.st_size)
+    _line_indexes[key] = index
+    _line_indexes.move_to_end(key)
+    while len(_line_indexes) > LINE_INDEX_CACHE_SIZE:
+        _line_indexes.popitem(last=False)
+    return index
+
+@app.tool()
+@cached_tool(_path_state)
+def read_file(path: str, start_line: int = 1, end_line: int = 500, tail: int = 0,
+              max_bytes: int = MAX_READ_BYTES) -> str:
+    """
+    Lê um arquivo por intervalo de linhas (ou as últimas `tail` linhas),
+    sem carregar o arquivo inteiro em memória
+    """
+    max_bytes = max(1, min(max_bytes, MAX_READ_BYTES))
+    with open(path, "rb") as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            size = st.st_size
+            if tail > 0:
+                search = size - 1 if mm[size - 1:size] == b"\n" else size
+                start = 0
+                for _ in range(tail):
+                    nl = mm.rfind(b"\n", 0, search)
+                    if nl == -1:
+                        start = 0
+                        break
+                    start = nl + 1
+                    search = nl
+                if size - start > max_bytes:
+                    skipped = size - max_bytes - start
+                    text = mm[size - max_bytes:size].decode("utf-8", errors="replace")
+                    return f"[... {skipped} bytes omitidos ...]\n{text}"
+                return mm[start:size].decode("utf-8", errors="replace")
+
+            start = _line_index(path, st).offset_of(mm, max(1, start_line))
+            if start is None:
+                return ""
+            limit = min(size, start + max_bytes)
+            end = start
+            for _ in range(max(0, end_line - max(1, start_line) + 1)):
+                nl = mm.find(b"\n", end, limit)
+                if nl == -1:
+                    end = limit
+                    break
+                end = nl + 1
+            text = mm[start:end].decode("utf-8", errors="replace")
+            if end == limit and limit < size and mm[end - 1:end] != b"\n":
+                text += f"\n[... resposta truncada em {max_bytes} bytes ...]"
+            return text
+
+@app.tool()
+@cached_tool(_path_state)
+def read_bytes(path: str, offset: int = 0, length: int = 65536) -> str:
+    """Lê um intervalo de bytes de um arquivo (offset negativo conta a partir do fim)"""
+    length = max(0, min(length, MAX_READ_BYTES))
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if offset < 0:
+            offset = max(0, size + offset)
+        f.seek(offset)
+        data = f.read(length)
+    return f"[bytes {offset}-{offset + len(data)} de {size}]\n" + data.decode("utf-8", errors="replace")
+
+# =========================
+# BUSCA EM ÁRVORES DE ARQUIVOS (scandir + .gitignore)
+# =========================
+TREE_INDEX_ENABLED = os.environ.get("MCP_TREE_INDEX", "1") != "0"
+TREE_INDEX_MAX_DIRS = 50000
+GREP_MAX_FILE_BYTES = int(os.environ.get("MCP_GREP_MAX_FILE_BYTES", str(10 * 1024 * 1024)))
+ALWAYS_IGNORED = {".git"}
+
+class IgnoreRules:
+    """Regras de .gitignore acumuladas da raiz da busca até a pasta atual"""
+
+    def __init__(self, rules=()):
+        self.rules = list(rules)
+
+    def child(self, directory: str) -> "IgnoreRules":
+        path = os.path.join(directory, ".gitignore")
+        if not os.path.isfile(path):
+            return self
+        rules = list(self.rules)
+        try:
+            with open(path, "r", encoding="utf-8", errors="replace") as f:
+                for line in f:
+                    line = line.rstrip("\n").rstrip()
+                    if not line or line.startswith("#"):
+                        continue
+                    negate = line.startswith("!")
+                    if negate:
+                        line = line[1:]
+                    dir_only = line.endswith("/")
+                    line = line.rstrip("/")
+                    anchored = "/" in line
+                    rules.append((directory, line.lstrip("/"), negate, dir_only, anchored))
+        except OSError:
+            return self
+        return IgnoreRules(rules)
+
+    def ignored(self, path: str, name: str, is_dir: bool) -> bool:
+        if name in ALWAYS_IGNORED:
+            return True
+        result = False
+        for base, pattern, negate, dir_only, anchored in self.rules:
+            if dir_only and not is_dir:
+                continue
+            target = os.path.relpath(path, base).replace(os.sep, "/") if anchored else name
+            if fnmatch.fnmatch(target, pattern):
+                result = not negate
+        return result
+
+# Índice em memória: pasta -> (mtime, entradas). Uma pasta só é relida quando
+# o seu mtime muda (arquivo criado, removido ou renomeado)
+_tree_index = OrderedDict()
+
+def _scan_dir(directory: str):
+    """Entradas (nome, é_pasta, tamanho) da pasta, ordenadas por nome"""
+    if not TREE_INDEX_ENABLED:
+        return _read_dir(directory)
+    mtime = os.stat(directory).st_mtime_ns
+    cached = _tree_index.get(directory)
+    if cached is not None and cached[0] == mtime:
+        _tree_index.move_to_end(directory)
+        return cached[1]
+    entries = _read_dir(directory)
+    _tree_index[directory] = (mtime, entries)
+    while len(_tree_index) > TREE_INDEX_MAX_DIRS:
+        _tree_index.popitem(last=False)
+    return entries
+
+def _read_dir(directory: str):
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                size = 0 if is_dir else entry.stat(follow_symlinks=False).st_size
+            except OSError:
+                continue
+            entries.append((entry.name, is_dir, size))
+    entries.sort()
+    return entries
+
+def _walk(root: str, max_depth: int):
+    """Gera (caminho, é_pasta, profundidade, tamanho) respeitando .gitignore"""
+    root = os.path.abspath(root)
+    stack = [(root, 1, IgnoreRules().child(root))]
+    while stack:
+        directory, depth, rules = stack.pop()
+        try:
+            entries = _scan_dir(directory)
+        except OSError:
+            continue
+        subdirs = []
+        for name, is_dir, size in entries:
+            path = os.path.join(directory, name)
+            if rules.ignored(path, name, is_dir):
+                continue
+            yield path, is_dir, depth, size
+            if is_dir and depth < max_depth:
+                subdirs.append(path)
+        for path in reversed(subdirs):
+            stack.append((path, depth + 1, rules.child(path)))
+
+def _page(lines: list, offset: int, limit: int, more: bool) -> str:
+    footer = f"[{len(lines)} resultados a partir de {offset}"
+    footer += f"; próxima página: offset={offset + len(lines)}]" if more else "; fim]"
+    return "\n".join(lines + [footer])
+
+def _glob_match(parts: list, pattern: list) -> bool:
+    """Glob por segmentos de caminho: * e ? não atravessam /, ** casa zero ou mais pastas"""
+    if not pattern:
+        return not parts
+    if pattern[0] == "**":
+        return any(_glob_match(parts[i:], pattern[1:]) for i in range(len(parts) + 1))
+    return bool(parts) and fnmatch.fnmatch(parts[0], pattern[0]) and _glob_match(parts[1:], pattern[1:])
+
+@app.tool()
+def walk_tree(path: str = ".", max_depth: int = 3, offset: int = 0, limit: int = 500) -> str:
+    """Lista a árvore de pastas recursivamente (respeita .gitignore), com paginação"""
+    lines = []
+    more = False
+    for i, (entry, is_dir, depth, size) in enumerate(_walk(path, max_depth)):
+        if i < offset:
+            continue
+        if len(lines) >= limit:
+            more = True
+            break
+        rel = os.path.relpath(entry, path)
+        lines.append(f"{rel}/" if is_dir else f"{rel} ({size} bytes)")
+    return _page(lines, offset, limit, more)
+
+@app.tool()
+def find_files(pattern: str, path: str = ".", max_depth: int = 20, offset: int = 0, limit: int = 200) -> str:
+    """
+    Procura arquivos por padrão glob, com paginação. Sem / o padrão é aplicado ao
+    nome do arquivo (ex: *.py); com / ao caminho relativo, segmento a segmento
+    (ex: src/*/test_*.py só desce uma pasta, src/**/test_*.py desce qualquer número).
+    """
+    lines = []
+    more = False
+    matched = 0
+    segments = [part for part in pattern.split("/") if part] if "/" in pattern else None
+    for entry, is_dir, depth, size in _walk(path, max_depth):
+        if is_dir:
+            continue
+        rel = os.path.relpath(entry, path).replace(os.sep, "/")
+        if segments is None:
+            if not fnmatch.fnmatch(os.path.basename(entry), pattern):
+                continue
+        elif not _glob_match(rel.split("/"), segments):
+            continue
+        matched += 1
+        if matched <= offset:
+            continue
+        if len(lines) >= limit:
+            more = True
+            break
+        lines.append(rel)
+    return _page(lines, offset, limit, more)
+
 @app.tool()
-def read_file(path: str, start_line: int = 1, end_line: int = 500) -> str:
-    """Lê um arquivo por intervalo de linhas"""
-    with open(path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    return "".join(lines[start_line - 1:end_line])
+async def grep_files(pattern: str, path: str = ".", glob: str = "*", regex: bool = False,
+                     ignore_case: bool = False, max_matches: int = 200, max_depth: int = 20,
+                     ctx: Context = None) -> str:
+    """
+    Procura texto nos arquivos da árvore (ignora binários e .gitignore).
+    Para ao atingir max_matches; as ocorrências são enviadas à medida que são encontradas.
+    """
+    flags = re.IGNORECASE if ignore_case else 0
+    matcher = re.compile(pattern if regex else re.escape(pattern), flags)
+    matches = []
+    scanned = 0
+    for entry, is_dir, depth, size in _walk(path, max_depth):
+        if is_dir or size > GREP_MAX_FILE_BYTES or not fnmatch.fnmatch(os.path.basename(entry), glob):
+            continue
+        scanned += 1
+        found = []
+        try:
+            with open(entry, "rb") as f:
+                if b"\0" in f.read(8192):
+                    continue
+                f.seek(0)
+                for number, raw in enumerate(f, 1):
+                    line = raw.decode("utf-8", errors="replace").rstrip("\n")
+                    if matcher.search(line):
+                        found.append(f"{os.path.relpath(entry, path)}:{number}: {line[:300]}")
+                        if len(matches) + len(found) >= max_matches:
+                            break
+        except OSError:
+            continue
+        if found:
+            matches.extend(found)
+            if ctx is not None:
+                try:
+                    await ctx.report_progress(len(matches), max_matches, "\n".join(found))
+                except Exception:
+                    pass
+        if len(matches) >= max_matches:
+            matches.append(f"[limite de {max_matches} ocorrências atingido; busca interrompida]")
+            break
+        if scanned % 200 == 0:
+            # Cede o event loop para outras requisições
+            await asyncio.sleep(0)
+    if not matches:
+        return f"Nenhuma ocorrência em {scanned} arquivos"
+    return "\n".join(matches)
 
 @app.tool()
 def write_file(path: str, content: str) -> str:
     """Cria ou sobrescreve um arquivo"""
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(content)
+    _atomic_write(path, content)
     return "Arquivo escrito com sucesso"
 
 @app.tool()
@@ -58,17 +590,533 @@ def append_file(path: str, content: str) -> str:
     """Adiciona conteúdo a um arquivo"""
     with open(path, "a", encoding="utf-8") as f:
         f.write(content)
+    result_cache.invalidate(GIT_TOOLS, path)
     return "Conteúdo adicionado"
 
+# =========================
+# EDIÇÃO DE ARQUIVOS (patch, substituição e lote)
+# =========================
+# Bytes recebidos nos argumentos de edição vs. o que uma reescrita completa custaria
+edit_bytes = {"received": 0, "full_rewrite": 0}
+
+# umask do processo, lido no arranque (os.umask só o consegue ler alterando-o)
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def _atomic_write(path: str, content: str):
+    """Escreve num arquivo temporário na mesma pasta e renomeia por cima do destino"""
+    # Através de symlinks: substitui o arquivo apontado, não o link
+    target = os.path.realpath(path)
+    directory = os.path.dirname(target)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(target))
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp cria com 0600: mantém o modo do existente ou usa o de um open() normal
+        if os.path.exists(target):
+            os.chmod(tmp, os.stat(target).st_mode & 0o7777)
+        else:
+            os.chmod(tmp, 0o666 & ~_UMASK)
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    result_cache.invalidate(GIT_TOOLS, path)
+
+def _track_edit(received: int, full_rewrite: int) -> str:
+    edit_bytes["received"] += received
+    edit_bytes["full_rewrite"] += full_rewrite
+    logging.info("edição: %d bytes recebidos (reescrita completa: %d)", received, full_rewrite)
+    return (f"{received} bytes recebidos (reescrita completa: {full_rewrite}); "
+            f"acumulado {edit_bytes['received']}/{edit_bytes['full_rewrite']}")
+
+def _read_text(path: str) -> str:
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        return f.read()
+
+def _patch_path(header: str):
+    name = header.split("\t")[0].strip()
+    if name == "/dev/null":
+        return None
+    if name.startswith(("a/", "b/")):
+        name = name[2:]
+    return name
+
+def _parse_patch(patch: str):
+    """Interpreta um diff unificado em [{old, new, hunks: [{start, old, new}]}]"""
+    files = []
+    current = None
+    hunk = None
+    last_tag = None
+    remaining_old = remaining_new = 0
+    # Só "\n" separa linhas: "\r" (CRLF), form feed, U+2028... fazem parte do conteúdo
+    lines = patch.split("\n")
+    if lines and lines[-1] == "":
+        lines.pop()
+    for raw in lines:
+        if hunk is not None and raw.startswith("\\"):
+            # "\ No newline at end of file" vale para o lado da linha anterior
+            if last_tag in (" ", "-"):
+                hunk["old_newline"] = False
+            if last_tag in (" ", "+"):
+                hunk["new_newline"] = False
+            continue
+        if hunk is not None and (remaining_old > 0 or remaining_new > 0):
+            tag, text = (raw[:1], raw[1:]) if raw else (" ", "")
+            last_tag = tag
+            if tag == " ":
+                hunk["old"].append(text)
+                hunk["new"].append(text)
+                remaining_old -= 1
+                remaining_new -= 1
+            elif tag == "-":
+                hunk["old"].append(text)
+                remaining_old -= 1
+            elif tag == "+":
+                hunk["new"].append(text)
+                remaining_new -= 1
+            else:
+                raise ValueError(f"Linha inválida no hunk: {raw!r}")
+            continue
+        if raw.startswith("--- "):
+            current = {"old": _patch_path(raw[4:]), "new": None, "hunks": []}
+            files.append(current)
+            hunk = None
+        elif raw.startswith("+++ ") and current is not None:
+            current["new"] = _patch_path(raw[4:])
+        elif raw.startswith("@@"):
+            match = re.match(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@", raw)
+            if match is None:
+                raise ValueError(f"Cabeçalho de hunk inválido: {raw!r}")
+            if current is None:
+                current = {"old": None, "new": None, "hunks": []}
+                files.append(current)
+            hunk = {"start": int(match.group(1)), "old": [], "new": []}
+            last_tag = None
+            remaining_old = int(match.group(2) or 1)
+            remaining_new = int(match.group(4) or 1)
+            current["hunks"].append(hunk)
+    return files
+
+def _find_block(lines: list, block: list, expected: int):
+    """Posição do bloco mais próxima da esperada (tolera deslocamentos)"""
+    if not block:
+        return max(0, min(expected, len(lines)))
+    for distance in range(len(lines) + 1):
+        for pos in (expected - distance, expected + distance):
+            if 0 <= pos <= len(lines) - len(block) and lines[pos:pos + len(block)] == block:
+                return pos
+    return None
+
+def _apply_hunks(content: str, hunks: list) -> str:
+    # Arquivo vazio (ou a criar) não tem linhas, nem sequer uma vazia
+    lines = content.split("\n") if content else []
+    trailing_newline = content.endswith("\n") or not content
+    if content and content.endswith("\n"):
+        lines.pop()
+    delta = 0
+    for hunk in hunks:
+        expected = max(0, hunk["start"] - 1) + delta
+        pos = _find_block(lines, hunk["old"], expected)
+        if pos is None:
+            raise ValueError(f"Hunk @@ -{hunk['start']} não corresponde ao conteúdo do arquivo")
+        lines[pos:pos + len(hunk["old"])] = hunk["new"]
+        delta += (pos - expected) + len(hunk["new"]) - len(hunk["old"])
+        # Hunk no fim do arquivo: o patch decide a quebra de linha final
+        if pos + len(hunk["new"]) == len(lines):
+            if hunk.get("new_newline") is False:
+                trailing_newline = False
+            elif hunk.get("old_newline") is False:
+                trailing_newline = True
+    result = "\n".join(lines)
+    if lines and trailing_newline:
+        result += "\n"
+    return result
+
+@app.tool()
+def edit_file(path: str, old_text: str, new_text: str, replace_all: bool = False) -> str:
+    """
+    Substitui old_text por new_text no arquivo, sem reenviar o arquivo inteiro.
+    old_text deve ser único, a não ser que replace_all seja verdadeiro.
+    """
+    content = _read_text(path)
+    occurrences = content.count(old_text) if old_text else 0
+    if occurrences == 0:
+        raise ValueError("old_text não encontrado no arquivo")
+    if occurrences > 1 and not replace_all:
+        raise ValueError(f"old_text aparece {occurrences} vezes; inclua mais contexto ou use replace_all")
+    updated = content.replace(old_text, new_text) if replace_all else content.replace(old_text, new_text, 1)
+    _atomic_write(path, updated)
+    stats = _track_edit(len(old_text.encode()) + len(new_text.encode()), len(updated.encode()))
+    return f"{occurrences if replace_all else 1} substituição(ões) em {path}; {stats}"
+
+@app.tool()
+def apply_patch(patch: str, path: str = None) -> str:
+    """
+    Aplica um diff unificado (um ou vários arquivos). Com `path`, os hunks são
+    aplicados a esse arquivo independentemente dos cabeçalhos.
+    Todos os hunks são validados antes de qualquer arquivo ser escrito.
+    """
+    files = _parse_patch(patch)
+    if not files:
+        raise ValueError("Nenhum hunk encontrado no patch")
+    if path is not None:
+        files = [{"old": path, "new": path, "hunks": [h for f in files for h in f["hunks"]]}]
+
+    planned = []
+    for entry in files:
+        target = entry["new"] or entry["old"]
+        if target is None:
+            raise ValueError("Patch sem caminho de arquivo")
+        if entry["new"] is None:
+            planned.append((target, None))
+            continue
+        original = _read_text(entry["old"]) if entry["old"] is not None else ""
+        planned.append((target, _apply_hunks(original, entry["hunks"])))
+
+    full_rewrite = 0
+    for target, updated in planned:
+        if updated is None:
+            os.remove(target)
+            result_cache.invalidate(GIT_TOOLS, target)
+            continue
+        parent = os.path.dirname(target)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        _atomic_write(target, updated)
+        full_rewrite += len(updated.encode())
+    stats = _track_edit(len(patch.encode()), full_rewrite)
+    return f"Patch aplicado em {len(planned)} arquivo(s): {', '.join(t for t, _ in planned)}; {stats}"
+
+@app.tool()
+def write_files(files: Dict[str, str]) -> str:
+    """Cria ou sobrescreve vários arquivos numa única chamada ({caminho: conteúdo})"""
+    for path, content in files.items():
+        parent = os.path.dirname(path)
+        if parent:
+            os.makedirs(parent, exist_ok=True)
+        _atomic_write(path, content)
+    written = sum(len(content.encode()) for content in files.values())
+    stats = _track_edit(written, written)
+    return f"{len(files)} arquivo(s) escrito(s): {', '.join(files)}; {stats}"
+
+OUTPUT_CHUNK_SIZE = 4096
+
+# =========================
+# PROCESSOS (execução assíncrona com handle)
+# =========================
+MAX_OUTPUT_BYTES = int(os.environ.get("MCP_MAX_OUTPUT_BYTES", str(256 * 1024)))
+# Segundos entre SIGTERM e SIGKILL ao cancelar um comando
+CANCEL_GRACE = 5.0
+MAX_PROCESSES = int(os.environ.get("MCP_MAX_PROCESSES", "32"))
+
+class OutputBuffer:
+    """
+    Buffer circular de saída: guarda apenas os últimos max_bytes.
+    Offsets são absolutos, permitindo leitura incremental mesmo após descartes.
+    """
+
+    def __init__(self, max_bytes: int = MAX_OUTPUT_BYTES):
+        self.max_bytes = max_bytes
+        self.data = bytearray()
+        self.start = 0
+
+    @property
+    def end(self) -> int:
+        return self.start + len(self.data)
+
+    def write(self, chunk: bytes):
+        self.data += chunk
+        overflow = len(self.data) - self.max_bytes
+        if overflow > 0:
+            del self.data[:overflow]
+            self.start += overflow
+
+    def read(self, offset: int, max_bytes: int):
+        """Retorna (texto, novo offset, bytes perdidos antes do offset)"""
+        lost = max(0, self.start - offset)
+        offset = max(offset, self.start)
+        piece = bytes(self.data[offset - self.start:offset - self.start + max_bytes])
+        return piece.decode("utf-8", errors="replace"), offset + len(piece), lost
+
+    def text(self) -> str:
+        prefix = f"[... {self.start} bytes descartados ...]\n" if self.start else ""
+        return prefix + self.data.decode("utf-8", errors="replace")
+
+class ManagedProcess:
+    """Processo em execução com saída em buffer circular e listeners de streaming"""
+
+    def __init__(self, handle: str, command: str, process):
+        self.handle = handle
+        self.command = command
+        self.process = process
+        self.stdout = OutputBuffer()
+        self.stderr = OutputBuffer()
+        self.cursors = {"stdout": 0, "stderr": 0}
+        self.listeners = set()
+        self.started_at = time.time()
+        self.ended_at = None
+        self.done = asyncio.Event()
+        self.span = tracing.start_span("subprocess", {"process.command": command[:200], "process.pid": process.pid})
+        self._task = asyncio.create_task(self._pump())
+
+    @property
+    def running(self) -> bool:
+        return not self.done.is_set()
+
+    async def _drain(self, stream, buffer, label):
+        while True:
+            chunk = await stream.read(OUTPUT_CHUNK_SIZE)
+            if not chunk:
+                break
+            buffer.write(chunk)
+            text = chunk.decode("utf-8", errors="replace")
+            for listener in list(self.listeners):
+                try:
+                    await listener(label, text)
+                except Exception:
+                    pass
+
+    async def _pump(self):
+        try:
+            await asyncio.gather(
+                self._drain(self.process.stdout, self.stdout, "stdout"),
+                self._drain(self.process.stderr, self.stderr, "stderr")
+            )
+            await self.process.wait()
+        finally:
+            self.ended_at = time.time()
+            self.span.set("process.exit_code", self.process.returncode)
+            self.span.set("process.output.bytes", self.stdout.end + self.stderr.end)
+            self.span.end()
+            self.done.set()
+
+    def status(self) -> str:
+        if self.running:
+            elapsed = time.time() - self.started_at
+            return f"em execução (pid={self.process.pid}, {elapsed:.1f}s)"
+        elapsed = self.ended_at - self.started_at
+        return f"finalizado (exit={self.process.returncode}, {elapsed:.1f}s)"
+
+    async def send_input(self, text: str):
+        self.process.stdin.write(text.encode("utf-8"))
+        await self.process.stdin.drain()
+
+    def cancel(self):
+        """Termina o processo e os seus filhos (grupo de processos)"""
+        if not self.running:
+            return
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(self.process.pid, signal.SIGTERM)
+            else:
+                self.process.terminate()
+        except ProcessLookupError:
+            pass
+
+    def kill(self):
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(self.process.pid, signal.SIGKILL)
+            else:
+                self.process.kill()
+        except ProcessLookupError:
+            pass
+
+    def terminate(self, grace: float = None):
+        """SIGTERM agora e SIGKILL após `grace` segundos se ainda executar (sem await)"""
+        self.cancel()
+        grace = CANCEL_GRACE if grace is None else grace
+        asyncio.get_running_loop().call_later(grace, lambda: self.running and self.kill())
+
+processes = {}
+
+# Executor nativo opcional (libscpp/libexec): posix_spawn + poll, sem o GIL
+try:
+    import libexec
+    LIBEXEC_AVAILABLE = hasattr(libexec, "execute")
+except Exception:
+    LIBEXEC_AVAILABLE = False
+NATIVE_EXEC = LIBEXEC_AVAILABLE and os.environ.get("MCP_NATIVE_EXEC") == "1"
+
+async def _run_native(command: str, timeout: float) -> str:
+    """run_command via libexec: sem streaming nem handle, o comando é morto no timeout"""
+    try:
+        with tracing.span("subprocess", {"process.command": command[:200], "process.native": True}) as span:
+            result = await asyncio.to_thread(
+                libexec.execute, ["/bin/sh", "-c", command], float(timeout or 0), MAX_OUTPUT_BYTES
+            )
+            span.set("process.exit_code", result.exit_code)
+            span.set("process.output.bytes", len(result.stdout) + len(result.stderr))
+    except Exception as e:
+        return str(e)
+    result_cache.clear()
+    prefix = f"Comando excedeu {timeout} segundos\n" if result.timed_out else ""
+    dropped = f"[... {result.dropped} bytes descartados ...]\n" if result.dropped else ""
+    stdout = result.stdout.decode("utf-8", errors="replace")
+    stderr = result.stderr.decode("utf-8", errors="replace")
+    return f"{prefix}{dropped}STDOUT:\n{stdout}\nSTDERR:\n{stderr}"
+
+async def _spawn(command: str, cwd: str = None) -> ManagedProcess:
+    # Descarta os processos finalizados mais antigos
+    finished = [p for p in processes.values() if not p.running]
+    for proc in sorted(finished, key=lambda p: p.started_at)[:max(0, len(processes) - MAX_PROCESSES + 1)]:
+        processes.pop(proc.handle, None)
+
+    process = await asyncio.create_subprocess_shell(
+        command,
+        cwd=cwd,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        start_new_session=hasattr(os, "killpg")
+    )
+    # Comandos arbitrários podem alterar qualquer coisa
+    result_cache.clear()
+    handle = uuid.uuid4().hex[:8]
+    managed = ManagedProcess(handle, command, process)
+    processes[handle] = managed
+    return managed
+
+def _get_process(handle: str) -> ManagedProcess:
+    if handle not in processes:
+        raise ValueError(f"Handle de processo desconhecido: {handle}")
+    return processes[handle]
+
 @app.tool()
-def run_command(command: str) -> str:
+async def run_command(command: str, timeout: float = 60, ctx: Context = None) -> str:
     """
-    Executa comandos no terminal (LOCAL)
+    Executa comandos no terminal (LOCAL).
+    Se o comando não terminar em `timeout` segundos (0 = sem limite), continua
+    em segundo plano e retorna um handle para read_output/send_input/cancel_command.
     """
+    if NATIVE_EXEC:
+        return await _run_native(command, timeout)
+
+    try:
+        managed = await _spawn(command)
+    except Exception as e:
+        return str(e)
+
+    async def report(label, text):
+        # Envia a saída parcial ao cliente enquanto o comando executa
+        await ctx.report_progress(managed.stdout.end + managed.stderr.end, None, f"[{label}] {text}")
+
+    if ctx is not None:
+        managed.listeners.add(report)
+    try:
+        await asyncio.wait_for(asyncio.shield(managed.done.wait()), timeout=timeout or None)
+    except asyncio.CancelledError:
+        # Requisição cancelada pelo cliente (notifications/cancelled): encerra
+        # o grupo de processos sem await, pois a task já está a ser cancelada
+        managed.terminate()
+        raise
+    except asyncio.TimeoutError:
+        # A saída já retornada não é repetida pelo próximo read_output
+        managed.cursors = {"stdout": managed.stdout.end, "stderr": managed.stderr.end}
+        return (
+            f"Comando ainda em execução após {timeout}s (handle={managed.handle}). "
+            f"Use read_output, send_input ou cancel_command.\n"
+            f"STDOUT:\n{managed.stdout.text()}\nSTDERR:\n{managed.stderr.text()}"
+        )
+    finally:
+        managed.listeners.discard(report)
+
+    processes.pop(managed.handle, None)
+    result_cache.clear()
+    return f"STDOUT:\n{managed.stdout.text()}\nSTDERR:\n{managed.stderr.text()}"
+
+@app.tool()
+async def start_command(command: str, cwd: str = None) -> str:
+    """Inicia um comando em segundo plano e retorna o seu handle"""
+    managed = await _spawn(command, cwd)
+    return f"handle={managed.handle} pid={managed.process.pid}"
+
+@app.tool()
+def read_output(handle: str, max_bytes: int = 16384) -> str:
+    """Lê a saída nova (stdout/stderr) de um comando em segundo plano e o seu estado"""
+    managed = _get_process(handle)
+    parts = [f"Estado: {managed.status()}"]
+    for label, buffer in (("stdout", managed.stdout), ("stderr", managed.stderr)):
+        text, managed.cursors[label], lost = buffer.read(managed.cursors[label], max_bytes)
+        if lost:
+            parts.append(f"[... {lost} bytes de {label} descartados ...]")
+        remaining = buffer.end - managed.cursors[label]
+        more = f" (+{remaining} bytes pendentes)" if remaining else ""
+        parts.append(f"{label.upper()}{more}:\n{text}")
+    return "\n".join(parts)
+
+@app.tool()
+async def send_input(handle: str, text: str) -> str:
+    """Envia texto para o stdin de um comando em segundo plano"""
+    managed = _get_process(handle)
+    if not managed.running:
+        return f"Processo {handle} já {managed.status()}"
+    await managed.send_input(text)
+    result_cache.clear()
+    return f"{len(text)} caracteres enviados para {handle}"
+
+@app.tool()
+async def cancel_command(handle: str) -> str:
+    """Cancela um comando em segundo plano (inclui processos filhos)"""
+    managed = _get_process(handle)
+    managed.cancel()
+    try:
+        await asyncio.wait_for(managed.done.wait(), timeout=CANCEL_GRACE)
+    except asyncio.TimeoutError:
+        managed.kill()
+        await managed.done.wait()
+    return f"Processo {handle} {managed.status()}"
+
+# =========================
+# GIT
+# =========================
+# Backend nativo (libgit2) opcional: status/log/diff/add sem fork de processos.
+# Como o pyautogui, só é importado na primeira ferramenta git (pesa no arranque)
+PYGIT2_AVAILABLE = importlib.util.find_spec("pygit2") is not None
+pygit2 = None
+
+def _pygit2():
+    """Importa o pygit2 na primeira utilização; None se não estiver disponível"""
+    global pygit2, PYGIT2_AVAILABLE
+    if pygit2 is None and PYGIT2_AVAILABLE:
+        try:
+            import pygit2 as module
+        except Exception:
+            PYGIT2_AVAILABLE = False
+            return None
+        pygit2 = module
+    return pygit2
+
+_git_repos = {}
+
+def _git_repo():
+    """Repositório pygit2 do diretório atual, mantido aberto entre chamadas"""
+    if _pygit2() is None:
+        return None
+    git_dir = _git_dir()
+    if git_dir is None:
+        return None
+    key = os.path.realpath(git_dir)
+    if key not in _git_repos:
+        try:
+            _git_repos[key] = pygit2.Repository(key)
+        except Exception:
+            return None
+    repo = _git_repos[key]
+    # O índice em memória fica do primeiro acesso: relê-o se outro processo
+    # (git CLI, outro worker do pool) o alterou
+    repo.index.read(False)
+    return repo
+
+def _git_cli(*args: str) -> str:
+    """Executa o git sem shell (argumentos não são interpretados)"""
     try:
         result = subprocess.run(
-            command,
-            shell=True,
+            ["git", *args],
             capture_output=True,
             text=True,
             timeout=60
@@ -77,38 +1125,117 @@ def run_command(command: str) -> str:
     except Exception as e:
         return str(e)
 
-# =========================
-# GIT
-# =========================
+def _status_code(flags: int) -> str:
+    if flags & pygit2.GIT_STATUS_WT_NEW:
+        return "??"
+    index = " "
+    for flag, code in ((pygit2.GIT_STATUS_INDEX_NEW, "A"), (pygit2.GIT_STATUS_INDEX_MODIFIED, "M"),
+                       (pygit2.GIT_STATUS_INDEX_DELETED, "D"), (pygit2.GIT_STATUS_INDEX_RENAMED, "R"),
+                       (pygit2.GIT_STATUS_INDEX_TYPECHANGE, "T")):
+        if flags & flag:
+            index = code
+    worktree = " "
+    for flag, code in ((pygit2.GIT_STATUS_WT_MODIFIED, "M"), (pygit2.GIT_STATUS_WT_DELETED, "D"),
+                       (pygit2.GIT_STATUS_WT_RENAMED, "R"), (pygit2.GIT_STATUS_WT_TYPECHANGE, "T")):
+        if flags & flag:
+            worktree = code
+    return index + worktree
+
 @app.tool()
+@cached_tool(_git_state)
 def git_status() -> str:
     """Retorna o status do repositório Git"""
-    return run_command("git status")
+    repo = _git_repo()
+    if repo is None:
+        return _git_cli("status")
+    branch = "(sem commits)" if repo.head_is_unborn else (
+        "(HEAD destacado)" if repo.head_is_detached else repo.head.shorthand
+    )
+    lines = [f"Branch: {branch}"]
+    for path, flags in sorted(repo.status().items()):
+        if flags & pygit2.GIT_STATUS_IGNORED:
+            continue
+        lines.append(f"{_status_code(flags)} {path}")
+    if len(lines) == 1:
+        lines.append("Nada para commitar, árvore de trabalho limpa")
+    return "\n".join(lines)
 
 @app.tool()
+@cached_tool(_git_state)
 def git_diff() -> str:
     """Mostra diferenças não commitadas"""
-    return run_command("git diff")
+    repo = _git_repo()
+    if repo is None:
+        return _git_cli("diff")
+    return repo.diff().patch or ""
 
 @app.tool()
+@cached_tool(_git_state)
 def git_log(n: int = 5) -> str:
     """Mostra histórico de commits"""
-    return run_command(f"git log -n {n} --oneline")
+    repo = _git_repo()
+    if repo is None:
+        return _git_cli("log", "-n", str(n), "--oneline")
+    if repo.head_is_unborn:
+        return ""
+    lines = []
+    for commit in repo.walk(repo.head.target, pygit2.GIT_SORT_TOPOLOGICAL | pygit2.GIT_SORT_TIME):
+        if len(lines) >= n:
+            break
+        lines.append(f"{commit.short_id} {commit.message.splitlines()[0] if commit.message else ''}")
+    return "\n".join(lines)
+
+def _workdir_pathspecs(repo, paths):
+    """
+    Converte caminhos relativos ao diretório atual (como no git CLI) para
+    relativos à raiz do repositório, que é como o pygit2 os interpreta.
+    Retorna None se algum não puder ser convertido (fica para o CLI).
+    """
+    if repo.workdir is None:
+        return None
+    workdir = os.path.realpath(repo.workdir)
+    pathspecs = []
+    for path in paths:
+        if path.startswith(":"):
+            return None
+        # Só a pasta é resolvida: um symlink no repositório entra como link
+        absolute = os.path.abspath(path)
+        parent, name = os.path.split(absolute)
+        relative = os.path.relpath(os.path.join(os.path.realpath(parent), name), workdir)
+        if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+            return None
+        pathspecs.append(relative.replace(os.sep, "/"))
+    return pathspecs
 
 @app.tool()
 def git_add(files: str = ".") -> str:
     """Adiciona arquivos ao stage"""
-    return run_command(f"git add {files}")
+    repo = _git_repo()
+    pathspecs = _workdir_pathspecs(repo, shlex.split(files)) if repo is not None else None
+    if pathspecs is None:
+        result = _git_cli("add", *shlex.split(files))
+    else:
+        index = repo.index
+        index.add_all(pathspecs)
+        index.write()
+        result = f"Adicionado ao stage: {files}"
+    result_cache.invalidate(GIT_TOOLS)
+    return result
 
 @app.tool()
 def git_commit(message: str) -> str:
     """Cria um commit"""
-    return run_command(f'git commit -m "{message}"')
+    # Via CLI para respeitar hooks e assinatura; a mensagem vai como argumento, sem shell
+    result = _git_cli("commit", "-m", message)
+    result_cache.invalidate(GIT_TOOLS)
+    return result
 
 @app.tool()
 def git_push(branch: str = "main") -> str:
     """Faz push para o repositório remoto"""
-    return run_command(f"git push origin {branch}")
+    result = _git_cli("push", "origin", branch)
+    result_cache.invalidate(GIT_TOOLS)
+    return result
 
 # =========================
 # AUTOMAÇÃO DE PC (pyautogui)
@@ -117,89 +1244,321 @@ if PYAUTOGUI_AVAILABLE:
     @app.tool()
     def screen_size() -> str:
         """Retorna resolução da tela"""
-        width, height = pyautogui.size()
+        width, height = _gui().size()
         return f"{width}x{height}"
 
     @app.tool()
     def mouse_position() -> str:
         """Retorna posição atual do mouse"""
-        x, y = pyautogui.position()
+        x, y = _gui().position()
         return f"x={x}, y={y}"
 
     @app.tool()
     def move_mouse(x: int, y: int, duration: float = 0.2) -> str:
         """Move o mouse para coordenadas específicas"""
-        pyautogui.moveTo(x, y, duration=duration)
+        _gui().moveTo(x, y, duration=duration)
         return f"Mouse movido para ({x}, {y})"
 
     @app.tool()
     def click(x: int = None, y: int = None, button: str = "left") -> str:
         """Clica com o mouse"""
-        pyautogui.click(x=x, y=y, button=button)
+        _gui().click(x=x, y=y, button=button)
         return f"Clique {button} executado"
 
     @app.tool()
     def double_click(x: int = None, y: int = None) -> str:
         """Clique duplo"""
-        pyautogui.doubleClick(x=x, y=y)
+        _gui().doubleClick(x=x, y=y)
         return "Clique duplo executado"
 
     @app.tool()
     def right_click(x: int = None, y: int = None) -> str:
         """Clique direito"""
-        pyautogui.rightClick(x=x, y=y)
+        _gui().rightClick(x=x, y=y)
         return "Clique direito executado"
 
     @app.tool()
     def type_text(text: str, interval: float = 0.02) -> str:
         """Digita texto no teclado"""
-        pyautogui.write(text, interval=interval)
+        _gui().write(text, interval=interval)
         return f"Texto digitado: '{text}'"
 
     @app.tool()
     def press_key(key: str) -> str:
         """Pressiona uma tecla específica"""
-        pyautogui.press(key)
+        _gui().press(key)
         return f"Tecla '{key}' pressionada"
 
     @app.tool()
     def hotkey(*keys: str) -> str:
         """Executa combinação de teclas (ex: ctrl, c)"""
-        pyautogui.hotkey(*keys)
+        _gui().hotkey(*keys)
         return f"Combinação executada: {'+'.join(keys)}"
 
     @app.tool()
     def screenshot(path: str = "screenshot.png") -> str:
         """Captura screenshot e salva em arquivo"""
-        img = pyautogui.screenshot()
+        img = _gui().screenshot()
         img.save(path)
         return f"Screenshot salva em {path}"
 
+    @app.tool()
+    def capture_screen(x: int = None, y: int = None, width: int = None, height: int = None,
+                       scale: float = 0.5, format: str = "jpeg", quality: int = 70,
+                       diff: bool = False) -> list:
+        """
+        Captura a tela (ou uma região) em memória, reduzida e comprimida (jpeg/webp/png).
+        Com diff=True retorna apenas os blocos que mudaram desde a captura anterior.
+        """
+        return _capture(x, y, width, height, scale, format, quality, diff)
+
+    @app.tool()
+    async def execute_actions(actions: List[dict], pause: float = 0.05, stop_on_error: bool = True) -> list:
+        """
+        Executa uma sequência de ações de GUI numa única chamada. Cada ação é um objeto
+        com "action": move(x,y,duration) | click(x,y,button,clicks) | type(text,interval) |
+        press(key,presses) | hotkey(keys: ["ctrl","c"] ou "ctrl+c") | scroll(clicks,x,y) | wait(seconds) |
+        screenshot(x,y,width,height,scale,format,quality,diff).
+        Retorna o tempo de cada passo; o failsafe, abort ou o limite de duração interrompem a sequência.
+        """
+        return await _execute_actions(actions, pause, stop_on_error)
+
     @app.tool()
     def scroll(clicks: int, x: int = None, y: int = None) -> str:
         """Rola a página (positivo = cima, negativo = baixo)"""
-        pyautogui.scroll(clicks, x=x, y=y)
+        _gui().scroll(clicks, x=x, y=y)
         return f"Scrolled {clicks} clicks"
 
+# =========================
+# CAPTURA DE TELA (em memória, reduzida, com diff por blocos)
+# =========================
+SCREEN_TILE = 64
+MAX_DIFF_TILES = 16
+IMAGE_FORMATS = {"jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP", "png": "PNG"}
+
+# Último quadro por (região, escala), usado no modo diff. LRU pequeno: cada
+# quadro é um bitmap completo e as regiões variam de chamada para chamada
+SCREEN_MAX_FRAMES = int(os.environ.get("MCP_SCREEN_MAX_FRAMES", "4"))
+_last_frames = OrderedDict()
+
+def _encode_image(img, format: str, quality: int) -> MCPImage:
+    fmt = IMAGE_FORMATS.get(format.lower())
+    if fmt is None:
+        raise ValueError(f"Formato não suportado: {format}")
+    if fmt == "JPEG" and img.mode != "RGB":
+        img = img.convert("RGB")
+    buffer = io.BytesIO()
+    if fmt == "PNG":
+        img.save(buffer, format=fmt, optimize=False)
+    else:
+        img.save(buffer, format=fmt, quality=max(1, min(quality, 100)))
+    return MCPImage(data=buffer.getvalue(), format=fmt.lower())
+
+# Imagens grandes fora de banda: o servidor grava o arquivo (ex: /dev/shm) e
+# devolve só o caminho; o cliente na mesma máquina lê e remove o arquivo
+OOB_DIR = os.environ.get("MCP_OOB_DIR")
+OOB_THRESHOLD = int(os.environ.get("MCP_OOB_THRESHOLD", str(256 * 1024)))
+OOB_MARKER = "[oob] "
+
+def _oob(image: MCPImage, format: str):
+    """Substitui a imagem por uma referência a arquivo se for grande"""
+    if not OOB_DIR or len(image.data) < OOB_THRESHOLD:
+        return image
+    fmt = IMAGE_FORMATS[format.lower()].lower()
+    os.makedirs(OOB_DIR, mode=0o700, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=OOB_DIR, prefix="mcp-", suffix=f".{fmt}")
+    with os.fdopen(fd, "wb") as f:
+        f.write(image.data)
+    return f"{OOB_MARKER}image/{fmt} {len(image.data)} {path}"
+
+def _changed_tiles(previous, current):
+    """Blocos (x, y, w, h) em que os dois quadros diferem"""
+    from PIL import ImageChops
+    delta = ImageChops.difference(previous, current)
+    if delta.getbbox() is None:
+        return []
+    width, height = current.size
+    tiles = []
+    for top in range(0, height, SCREEN_TILE):
+        bottom = min(top + SCREEN_TILE, height)
+        band = delta.crop((0, top, width, bottom)).getbbox()
+        if band is None:
+            continue
+        # Só percorre as colunas dentro da faixa alterada
+        first = band[0] - band[0] % SCREEN_TILE
+        for left in range(first, band[2], SCREEN_TILE):
+            box = (left, top, min(left + SCREEN_TILE, width), bottom)
+            if delta.crop(box).getbbox() is not None:
+                tiles.append(box)
+    return tiles
+
+def _capture(x, y, width, height, scale, format, quality, diff):
+    start = time.perf_counter()
+    region = None
+    if None not in (x, y, width, height):
+        region = (x, y, width, height)
+    img = _gui().screenshot(region=region)
+    scale = max(0.05, min(scale, 1.0))
+    if scale < 1.0:
+        factor = round(1 / scale)
+        if abs(factor * scale - 1) < 1e-6:
+            # Fator inteiro: reduce() é bem mais rápido que resize()
+            img = img.reduce(factor)
+        else:
+            from PIL import Image as PILImage
+            size = (max(1, int(img.width * scale)), max(1, int(img.height * scale)))
+            img = img.resize(size, PILImage.BILINEAR)
+    key = (region, scale)
+    previous = _last_frames.pop(key, None)
+    _last_frames[key] = img
+    while len(_last_frames) > max(1, SCREEN_MAX_FRAMES):
+        _last_frames.popitem(last=False)
+
+    if not diff or previous is None or previous.size != img.size:
+        image = _encode_image(img, format, quality)
+        elapsed = 1000 * (time.perf_counter() - start)
+        return [f"Quadro completo {img.width}x{img.height} (escala {scale}), "
+                f"{len(image.data)} bytes, {elapsed:.0f} ms", _oob(image, format)]
+
+    tiles = _changed_tiles(previous, img)
+    if not tiles:
+        return ["Sem alterações desde a captura anterior"]
+    if len(tiles) > MAX_DIFF_TILES:
+        # Muitos blocos: envia o retângulo que os contém
+        left = min(t[0] for t in tiles)
+        top = min(t[1] for t in tiles)
+        right = max(t[2] for t in tiles)
+        bottom = max(t[3] for t in tiles)
+        tiles = [(left, top, right, bottom)]
+    images = [_encode_image(img.crop(box), format, quality) for box in tiles]
+    elapsed = 1000 * (time.perf_counter() - start)
+    listing = ", ".join(f"({l},{t},{r - l}x{b - t})" for l, t, r, b in tiles)
+    summary = (f"{len(tiles)} bloco(s) alterado(s) em coordenadas do quadro {img.width}x{img.height} "
+               f"(escala {scale}): {listing}; {sum(len(i.data) for i in images)} bytes, {elapsed:.0f} ms")
+    return [summary, *(_oob(image, format) for image in images)]
+
+# =========================
+# MACROS DE GUI (várias ações numa única chamada)
+# =========================
+MAX_ACTION_WAIT = 10.0
+# Duração máxima de um lote; o passo em curso termina, os seguintes não executam
+MAX_ACTIONS_SECONDS = float(os.environ.get("MCP_ACTIONS_MAX_SECONDS", "60"))
+
+def _hotkey_keys(keys) -> list:
+    """Teclas de um hotkey: lista ["ctrl", "c"] ou string "ctrl+c" (teclas separadas por +)"""
+    if isinstance(keys, str):
+        keys = [key.strip() for key in keys.split("+")]
+    if not isinstance(keys, (list, tuple)) or not keys or not all(isinstance(key, str) and key for key in keys):
+        raise ValueError(f'hotkey: "keys" deve ser uma lista de teclas ou uma string como "ctrl+c" (recebido {keys!r})')
+    return list(keys)
+
+def _run_action(step: dict):
+    """Executa uma ação de GUI (bloqueante, numa thread); retorna conteúdo extra (ex: imagens) ou None"""
+    kind = step.get("action")
+    # _pause=False: sem o PAUSE global do pyautogui; a pausa entre passos é do lote
+    if kind == "move":
+        _gui().moveTo(step["x"], step["y"], duration=step.get("duration", 0), _pause=False)
+    elif kind == "click":
+        _gui().click(x=step.get("x"), y=step.get("y"), clicks=step.get("clicks", 1),
+                        button=step.get("button", "left"), _pause=False)
+    elif kind == "type":
+        _gui().write(step["text"], interval=step.get("interval", 0), _pause=False)
+    elif kind == "press":
+        _gui().press(step["key"], presses=step.get("presses", 1), _pause=False)
+    elif kind == "hotkey":
+        _gui().hotkey(*_hotkey_keys(step.get("keys")), _pause=False)
+    elif kind == "scroll":
+        _gui().scroll(step["clicks"], x=step.get("x"), y=step.get("y"), _pause=False)
+    elif kind == "screenshot":
+        return _capture(step.get("x"), step.get("y"), step.get("width"), step.get("height"),
+                        step.get("scale", 0.5), step.get("format", "jpeg"),
+                        step.get("quality", 70), step.get("diff", False))[1:]
+    else:
+        raise ValueError(f"Ação desconhecida: {kind}")
+    return None
+
+async def _execute_actions(actions: List[dict], pause: float, stop_on_error: bool) -> list:
+    lines = []
+    extra = []
+    completed = 0
+    gui = _gui()
+    pause = max(0.0, pause)
+    total = time.perf_counter()
+    deadline = total + MAX_ACTIONS_SECONDS
+    for i, step in enumerate(actions, 1):
+        # Pausa entre passos no event loop (o PAUSE global do pyautogui não é alterado)
+        if i > 1 and pause and await _sleep_or_abort(min(pause, max(0.0, deadline - time.perf_counter()))):
+            lines.append(f"{i}. {step.get('action')}: não executada (abort)")
+            break
+        start = time.perf_counter()
+        if start >= deadline:
+            lines.append(f"{i}. {step.get('action')}: não executada (limite de {MAX_ACTIONS_SECONDS:g} s do lote)")
+            break
+        try:
+            if step.get("action") == "wait":
+                # Espera no event loop: não bloqueia o servidor e abort a interrompe
+                seconds = min(float(step.get("seconds", 0)), MAX_ACTION_WAIT, deadline - start)
+                if await _sleep_or_abort(seconds):
+                    lines.append(f"{i}. wait: interrompida por abort")
+                    break
+                result = None
+            else:
+                result = await asyncio.to_thread(_run_action, step)
+            if result:
+                extra.extend(result)
+            completed += 1
+            lines.append(f"{i}. {step.get('action')}: ok ({1000 * (time.perf_counter() - start):.0f} ms)")
+        except gui.FailSafeException:
+            lines.append(f"{i}. {step.get('action')}: ABORTADO pelo failsafe (mouse no canto da tela)")
+            break
+        except Exception as e:
+            lines.append(f"{i}. {step.get('action')}: erro: {e} ({1000 * (time.perf_counter() - start):.0f} ms)")
+            if stop_on_error:
+                break
+    lines.append(f"{completed}/{len(actions)} ações concluídas em {1000 * (time.perf_counter() - total):.0f} ms")
+    return ["\n".join(lines), *extra]
+
 # =========================
 # CONTROLE / SEGURANÇA
 # =========================
+# Esperas em curso, interrompidas por abort()
+_abort_waiters = set()
+
+async def _sleep_or_abort(seconds: float) -> bool:
+    """Dorme sem bloquear o event loop; retorna True se abort() interrompeu"""
+    event = asyncio.Event()
+    _abort_waiters.add(event)
+    try:
+        await asyncio.wait_for(event.wait(), timeout=max(0.0, seconds))
+        return True
+    except asyncio.TimeoutError:
+        return False
+    finally:
+        _abort_waiters.discard(event)
+
 @app.tool()
-def wait(seconds: float) -> str:
-    """Pausa execução por N segundos"""
-    import time
-    time.sleep(seconds)
+async def wait(seconds: float) -> str:
+    """Pausa por N segundos sem bloquear o servidor (interrompida por abort ou cancelamento)"""
+    if await _sleep_or_abort(seconds):
+        return "Espera interrompida por abort"
     return f"Aguardou {seconds} segundos"
 
 @app.tool()
 def abort() -> str:
-    """Abortar execução (emergência)"""
-    raise RuntimeError("Execução abortada manualmente pelo usuário")
+    """Abortar execução (emergência): cancela os comandos em execução e as esperas pendentes"""
+    running = [p for p in processes.values() if p.running]
+    for managed in running:
+        managed.terminate()
+    waiters = list(_abort_waiters)
+    for event in waiters:
+        event.set()
+    return f"Abortado: {len(running)} comando(s) cancelado(s), {len(waiters)} espera(s) interrompida(s)"
 
 # =========================
 # INFORMAÇÕES DO SISTEMA
 # =========================
 @app.tool()
+@cached_tool()
 def system_info() -> str:
     """Retorna informações do sistema"""
     import platform
@@ -214,6 +1573,63 @@ def system_info() -> str:
     }
     return "\n".join([f"{k}: {v}" for k, v in info.items()])
 
+@app.tool()
+def cache_stats() -> str:
+    """Estatísticas do cache de resultados (hits/misses por ferramenta)"""
+    tools = sorted(set(result_cache.hits) | set(result_cache.misses))
+    lines = [
+        f"Cache: {'ativo' if RESULT_CACHE_ENABLED else 'desativado'}",
+        f"Entradas: {len(result_cache.entries)} ({result_cache.size}/{result_cache.max_bytes} bytes)",
+        f"Não guardados (acima de {result_cache.max_item} bytes): {result_cache.skipped}",
+        f"Invalidações: {result_cache.invalidations}",
+    ]
+    for tool in tools:
+        hits = result_cache.hits.get(tool, 0)
+        misses = result_cache.misses.get(tool, 0)
+        lines.append(f"{tool}: {hits} hits, {misses} misses ({100 * hits / (hits + misses):.0f}%)")
+    return "\n".join(lines)
+
+@app.tool()
+def server_metrics() -> str:
+    """Tempos de execução das ferramentas medidos no servidor (uso interno, JSON)"""
+    return json.dumps(tool_timings)
+
+# =========================
+# TRANSPORTE
+# =========================
+# stdio: um servidor por cliente (padrão). http/unix: um servidor de longa
+# duração partilhado por vários workers do web_server (streamable HTTP).
+MCP_TRANSPORT = os.environ.get("MCP_TRANSPORT", "stdio")
+MCP_URL = os.environ.get("MCP_URL", "http://127.0.0.1:8765/mcp")
+MCP_SOCKET = os.environ.get("MCP_SOCKET") or os.path.join(
+    tempfile.gettempdir(), f"mcp-devops-{os.environ.get('USER', 'user')}", "mcp.sock"
+)
+
+def serve():
+    if MCP_TRANSPORT == "stdio":
+        app.run()
+        return
+    from urllib.parse import urlsplit
+    import uvicorn
+    url = urlsplit(MCP_URL)
+    app.settings.streamable_http_path = url.path or "/mcp"
+    if MCP_TRANSPORT == "http":
+        # Executa comandos arbitrários: não expor fora do localhost
+        app.settings.host = url.hostname or "127.0.0.1"
+        app.settings.port = url.port or 8765
+        print(f"   Transporte: streamable HTTP em {MCP_URL}")
+        app.run(transport="streamable-http")
+    elif MCP_TRANSPORT == "unix":
+        # O uvicorn cria o socket com permissão 0666: o acesso é limitado
+        # pela pasta privada (0700)
+        os.makedirs(os.path.dirname(MCP_SOCKET), mode=0o700, exist_ok=True)
+        if os.path.exists(MCP_SOCKET):
+            os.unlink(MCP_SOCKET)
+        print(f"   Transporte: streamable HTTP no socket {MCP_SOCKET}")
+        uvicorn.run(app.streamable_http_app(), uds=MCP_SOCKET, log_level="warning")
+    else:
+        raise SystemExit(f"MCP_TRANSPORT inválido: {MCP_TRANSPORT} (use stdio, http ou unix)")
+
 # =========================
 # MAIN
 # =========================
@@ -221,4 +1637,4 @@ if __name__ == "__main__":
     print("🚀 Servidor MCP DevOps PC Agent iniciado")
     print(f"   PyAutoGUI: {'✓ Disponível' if PYAUTOGUI_AVAILABLE else '✗ Não disponível'}")
     print(f"   DISPLAY: {os.environ.get('DISPLAY', 'não configurado')}")
-    app.run()
+    serve()
@@ -97,6 +97,8 @@ case $BUILD_TYPE in
         pyinstaller --name mcp-agent \
             --add-data "index.html:." \
             --add-data "mcp_pc_devops_agent.py:." \
+            --add-data "tracing.py:." \
+            --add-data "agent_core.py:." \
             --hidden-import=mcp \
             --hidden-import=fastmcp \
             --hidden-import=groq \
@@ -111,6 +113,8 @@ case $BUILD_TYPE in
             --onefile \
             --add-data "index.html:." \
             --add-data "mcp_pc_devops_agent.py:." \
+            --add-data "tracing.py:." \
+            --add-data "agent_core.py:." \
             --hidden-import=mcp \
             --hidden-import=fastmcp \
             --hidden-import=groq \
@@ -125,6 +129,8 @@ case $BUILD_TYPE in
             --onefile \
             --add-data "index.html:." \
             --add-data "mcp_pc_devops_agent.py:." \
+            --add-data "tracing.py:." \
+            --add-data "agent_core.py:." \
             --hidden-import=mcp \
             --hidden-import=fastmcp \
             --hidden-import=groq \
@@ -140,6 +146,8 @@ case $BUILD_TYPE in
             --onefile \
             --add-data "index.html:." \
             --add-data "mcp_pc_devops_agent.py:." \
+            --add-data "tracing.py:." \
+            --add-data "agent_core.py:." \
             --hidden-import=mcp \
             --hidden-import=fastmcp \
             --hidden-import=groq \
@@ -203,7 +211,7 @@ if [ -f "$BUILD_PATH" ]; then
         tar -czf "release/$PACKAGE_NAME" \
             -C dist mcp-agent \
             -C .. index.html \
-            -C . mcp_pc_devops_agent.py
+            -C . mcp_pc_devops_agent.py tracing.py agent_core.py
         
         log_success "Pacote criado: release/$PACKAGE_NAME"
         echo -e "  ${PURPLE}📦 Tamanho:${NC} $(du -h release/$PACKAGE_NAME | cut -f1)"
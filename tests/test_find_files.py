@@ -0,0 +1,42 @@
+"""
+Semântica de glob do find_files: * não atravessa pastas e ** casa zero ou
+mais pastas (pytest tests/test_find_files.py).
+"""
+import os
+import importlib.util
+
+import pytest
+
+pytest.importorskip("mcp")
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mcp_pc_devops_agent.py")
+
+@pytest.fixture(scope="module")
+def server():
+    spec = importlib.util.spec_from_file_location("find_files_server", SERVER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def tree(tmp_path):
+    for rel in ("src/test_top.py", "src/a/test_one.py", "src/a/b/test_two.py", "src/a/notes.txt"):
+        target = tmp_path / rel
+        target.parent.mkdir(parents=True, exist_ok=True)
+        target.write_text("x\n")
+    return str(tmp_path)
+
+def found(server, pattern, path):
+    return sorted(server.find_files(pattern, path).splitlines()[:-1])
+
+def test_star_stays_in_one_directory(server, tree):
+    assert found(server, "src/*/test_*.py", tree) == ["src/a/test_one.py"]
+    assert found(server, "src/*.py", tree) == ["src/test_top.py"]
+
+def test_double_star_crosses_directories(server, tree):
+    assert found(server, "src/**/test_*.py", tree) == ["src/a/b/test_two.py", "src/a/test_one.py", "src/test_top.py"]
+    assert found(server, "**/b/*.py", tree) == ["src/a/b/test_two.py"]
+
+def test_pattern_without_slash_matches_name(server, tree):
+    assert found(server, "test_*.py", tree) == ["src/a/b/test_two.py", "src/a/test_one.py", "src/test_top.py"]
+    assert found(server, "*.txt", tree) == ["src/a/notes.txt"]
@@ -0,0 +1,135 @@
+"""
+Teste de carga do backend LLM do web_server contra um endpoint falso local
+(GROQ_BASE_URL): N sessões concorrentes progridem em paralelo e o event loop
+continua a responder enquanto esperam pelo LLM
+(pytest tests/test_llm_concurrency.py).
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+for module in ("aiohttp", "groq", "httpx", "mcp"):
+    pytest.importorskip(module)
+
+APPLICATION = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "application")
+SESSIONS = int(os.environ.get("LOAD_TEST_SESSIONS", "8"))
+# Latência de cada resposta do LLM falso (antes do primeiro token)
+LLM_DELAY = 0.5
+REPLY = ["Olá", " do", " LLM", " falso"]
+MAX_LOOP_LAG = 0.1
+
+class FakeLLM(BaseHTTPRequestHandler):
+    """chat.completions compatível com a API (stream SSE), com latência fixa"""
+    active = 0
+    peak = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with FakeLLM.lock:
+            FakeLLM.active += 1
+            FakeLLM.peak = max(FakeLLM.peak, FakeLLM.active)
+        try:
+            time.sleep(LLM_DELAY)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            deltas = [{"role": "assistant", "content": piece} for piece in REPLY] + [{}]
+            for i, delta in enumerate(deltas):
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": "fake",
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if i == len(REPLY) else None}]
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(b"data: [DONE]\n\n")
+        finally:
+            with FakeLLM.lock:
+                FakeLLM.active -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+class FakeLLMServer(ThreadingHTTPServer):
+    # Todas as sessões ligam-se ao mesmo tempo
+    request_queue_size = 128
+    daemon_threads = True
+
+@pytest.fixture(scope="module")
+def web_server():
+    """web_server importado com o cliente apontado para o LLM falso"""
+    server = FakeLLMServer(("127.0.0.1", 0), FakeLLM)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    previous = {k: os.environ.get(k) for k in ("GROQ_BASE_URL", "GROQ_API_KEY", "LLM_CACHE", "LLM_MAX_CONCURRENCY")}
+    os.environ.update({
+        "GROQ_BASE_URL": f"http://127.0.0.1:{server.server_address[1]}",
+        "GROQ_API_KEY": "fake",
+        "LLM_CACHE": "off",
+        "LLM_MAX_CONCURRENCY": str(SESSIONS)
+    })
+    sys.path.insert(0, APPLICATION)
+    try:
+        import web_server
+        yield web_server
+    finally:
+        sys.path.remove(APPLICATION)
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        server.shutdown()
+
+def test_sessions_progress_in_parallel(web_server):
+    async def run():
+        lag = 0.0
+        done = asyncio.Event()
+
+        async def ticker(interval=0.01):
+            # Atraso do event loop enquanto as sessões esperam pelo LLM
+            nonlocal lag
+            while not done.is_set():
+                start = time.perf_counter()
+                await asyncio.sleep(interval)
+                lag = max(lag, time.perf_counter() - start - interval)
+
+        async def session_turn(i):
+            tokens = []
+
+            async def emit(frame):
+                if frame["type"] == "token":
+                    tokens.append(frame["content"])
+
+            session = web_server.UserSession(f"load-{i}")
+            response = await session.process_message(f"pergunta {i}", emit=emit)
+            return response, "".join(tokens)
+
+        tick = asyncio.create_task(ticker())
+        start = time.perf_counter()
+        try:
+            results = await asyncio.gather(*(session_turn(i) for i in range(SESSIONS)))
+        finally:
+            done.set()
+            await tick
+        return time.perf_counter() - start, lag, results
+
+    elapsed, lag, results = asyncio.run(run())
+
+    for response, streamed in results:
+        assert "error" not in response, response["error"]
+        assert response["content"] == "".join(REPLY)
+        assert streamed == "".join(REPLY)
+    # Em série seriam SESSIONS * LLM_DELAY; em paralelo, pouco mais de um LLM_DELAY
+    assert FakeLLM.peak == SESSIONS, f"no máximo {FakeLLM.peak} pedidos simultâneos ao LLM"
+    assert elapsed < LLM_DELAY * max(2, SESSIONS / 2), f"{SESSIONS} sessões levaram {elapsed:.2f}s"
+    assert lag < MAX_LOOP_LAG, f"event loop parado {1000 * lag:.0f} ms"
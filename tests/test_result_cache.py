@@ -0,0 +1,53 @@
+"""
+Cache de resultados com vários servidores (pool do web_server): cada worker
+é um processo com o seu cache, e as escritas feitas por um têm de ser vistas
+pelo outro (pytest tests/test_result_cache.py).
+"""
+import os
+import shutil
+import subprocess
+import importlib.util
+
+import pytest
+
+pytest.importorskip("mcp")
+if shutil.which("git") is None:
+    pytest.skip("git não encontrado", allow_module_level=True)
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mcp_pc_devops_agent.py")
+
+def load_worker(name):
+    """Instância independente do módulo do servidor (estado e cache próprios)"""
+    spec = importlib.util.spec_from_file_location(name, SERVER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@pytest.fixture
+def workers(tmp_path, monkeypatch):
+    monkeypatch.setenv("MCP_PEER_SERVERS", "2")
+    monkeypatch.setenv("MCP_RESULT_CACHE", "1")
+    monkeypatch.chdir(tmp_path)
+    subprocess.run(["git", "init", "-q"], check=True)
+    subprocess.run(["git", "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q",
+                    "--allow-empty", "-m", "init"], check=True)
+    return load_worker("worker_a"), load_worker("worker_b")
+
+def test_git_tools_see_writes_from_other_worker(workers):
+    a, b = workers
+    assert "notes.txt" not in b.git_status()
+    a.write_file("notes.txt", "primeira\n")
+    assert "notes.txt" in b.git_status()
+
+    subprocess.run(["git", "add", "notes.txt"], check=True)
+    subprocess.run(["git", "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "notes"], check=True)
+    assert "segunda" not in b.git_diff()
+    a.write_file("notes.txt", "segunda linha\n")
+    assert "segunda" in b.git_diff()
+
+def test_read_file_sees_writes_from_other_worker(workers):
+    a, b = workers
+    a.write_file("data.txt", "1\n")
+    assert "1" in b.read_file("data.txt")
+    a.write_file("data.txt", "22222\n")
+    assert "22222" in b.read_file("data.txt")
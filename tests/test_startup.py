@@ -0,0 +1,110 @@
+"""
+Arranque a frio do servidor MCP até a resposta ao initialize(), medido com
+-X importtime (pytest tests/test_startup.py). Orçamentos configuráveis:
+STARTUP_BUDGET_MS (importação, o mesmo do make startup) e
+STARTUP_INIT_BUDGET_MS (do spawn até a resposta ao initialize).
+"""
+import os
+import sys
+import json
+import time
+import select
+import subprocess
+
+import pytest
+
+pytest.importorskip("mcp")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STARTUP_BUDGET_MS = float(os.environ.get("STARTUP_BUDGET_MS", "800"))
+STARTUP_INIT_BUDGET_MS = float(os.environ.get("STARTUP_INIT_BUDGET_MS", "1500"))
+INIT_TIMEOUT = 30
+
+INITIALIZE = {
+    "jsonrpc": "2.0",
+    "id": 1,
+    "method": "initialize",
+    "params": {
+        "protocolVersion": "2025-03-26",
+        "capabilities": {},
+        "clientInfo": {"name": "startup-test", "version": "0"}
+    }
+}
+
+def _import_times(stderr):
+    """{módulo: (cumulativo em ms, próprio em ms)} a partir do log do -X importtime"""
+    times = {}
+    for line in stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[0][12:].strip().isdigit():
+            times[parts[2].strip()] = (int(parts[1]) / 1000, int(parts[0][12:]) / 1000)
+    return times
+
+def _report(times, limit=15):
+    rows = sorted(((c, o, name) for name, (c, o) in times.items()), reverse=True)[:limit]
+    return "\n".join(f"{c:9.1f} ms {o:9.1f} ms  {name}" for c, o, name in rows)
+
+@pytest.fixture(scope="module")
+def import_times():
+    """Importação do módulo do servidor com -X importtime (como no make startup)"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import mcp_pc_devops_agent"],
+        cwd=ROOT, env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"),
+        capture_output=True, text=True, timeout=INIT_TIMEOUT
+    )
+    assert result.returncode == 0, result.stderr[-2000:]
+    return _import_times(result.stderr)
+
+@pytest.fixture(scope="module")
+def cold_start():
+    """Inicia o servidor (stdio) e mede do spawn até a resposta ao initialize, em ms"""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    env.pop("MCP_TRANSPORT", None)
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "mcp_pc_devops_agent.py"],
+        cwd=ROOT, env=env, text=True,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    try:
+        process.stdin.write(json.dumps(INITIALIZE) + "\n")
+        process.stdin.flush()
+        deadline = start + INIT_TIMEOUT
+        while time.perf_counter() < deadline:
+            ready, _, _ = select.select([process.stdout], [], [], deadline - time.perf_counter())
+            if not ready:
+                break
+            line = process.stdout.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                # Banner do servidor ou outra saída que não é JSON-RPC
+                continue
+            if isinstance(message, dict) and message.get("id") == 1:
+                assert "result" in message, message
+                return 1000 * (time.perf_counter() - start)
+    finally:
+        process.kill()
+        _, stderr = process.communicate()
+    pytest.fail(f"Sem resposta ao initialize (limite {INIT_TIMEOUT}s):\n{stderr[-2000:]}")
+
+def test_import_within_budget(import_times):
+    total = import_times.get("mcp_pc_devops_agent", (0, 0))[0]
+    assert total <= STARTUP_BUDGET_MS, (
+        f"Importação do servidor: {total:.1f} ms (orçamento {STARTUP_BUDGET_MS:.0f} ms)\n{_report(import_times)}"
+    )
+
+def test_heavy_imports_deferred(import_times):
+    """pyautogui (e PIL, Xlib...) e pygit2 só são importados na primeira ferramenta que os usa"""
+    eager = sorted(
+        name for name in import_times if name.split(".")[0] in ("pyautogui", "pyscreeze", "Xlib", "pygit2")
+    )
+    assert not eager, f"Importados no arranque: {', '.join(eager)}"
+
+def test_initialize_within_budget(cold_start, import_times):
+    assert cold_start <= STARTUP_INIT_BUDGET_MS, (
+        f"Arranque até o initialize(): {cold_start:.1f} ms (orçamento {STARTUP_INIT_BUDGET_MS:.0f} ms)\n"
+        f"{_report(import_times)}"
+    )
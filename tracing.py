@@ -0,0 +1,226 @@
+"""
+Tracing leve no formato de spans do OpenTelemetry (traceId/spanId/parentSpanId,
+tempos em nanossegundos Unix, atributos e status), exportado em JSONL.
+
+Ativado com AGENT_TRACE_FILE=/caminho/trace.jsonl; sem a variável os spans
+continuam a ser criados (para os atributos) mas nada é gravado.
+O servidor MCP e os front-ends podem gravar no mesmo arquivo: cada span é
+uma única escrita em modo append.
+
+Caminho crítico de um turno:
+    python tracing.py trace.jsonl [trace_id]
+"""
+import os
+import sys
+import json
+import time
+import secrets
+import contextvars
+from contextlib import contextmanager
+
+TRACE_FILE = os.environ.get("AGENT_TRACE_FILE")
+SERVICE_NAME = os.environ.get("AGENT_SERVICE_NAME") or os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+
+_current = contextvars.ContextVar("agent_current_span", default=None)
+_fd = None
+
+class Span:
+    """Um span com os campos do modelo de dados do OpenTelemetry"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes",
+                 "start_ns", "end_ns", "status", "message")
+
+    def __init__(self, name, attributes=None, parent=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = dict(attributes or {})
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = "STATUS_CODE_OK"
+        self.message = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def error(self, message):
+        self.status = "STATUS_CODE_ERROR"
+        self.message = message
+
+    def end(self):
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        if TRACE_FILE:
+            _export(self)
+
+    def to_dict(self):
+        return {
+            "resource": {"service.name": SERVICE_NAME},
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": "SPAN_KIND_INTERNAL",
+            "startTimeUnixNano": self.start_ns,
+            "endTimeUnixNano": self.end_ns,
+            "attributes": self.attributes,
+            "status": {"code": self.status, "message": self.message or ""}
+        }
+
+def _export(span):
+    global _fd
+    try:
+        if _fd is None:
+            _fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n"
+        os.write(_fd, line.encode("utf-8"))
+    except OSError:
+        pass
+
+def current_span():
+    return _current.get()
+
+def start_span(name, attributes=None):
+    """Cria um span filho do span corrente sem o tornar corrente"""
+    return Span(name, attributes, _current.get())
+
+def activate(span):
+    """Torna o span corrente; devolve o token para deactivate()"""
+    return _current.set(span)
+
+def deactivate(token):
+    _current.reset(token)
+
+@contextmanager
+def span(name, attributes=None):
+    """Span corrente durante o bloco; exceções marcam o status como erro"""
+    current = start_span(name, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+# =========================
+# CAMINHO CRÍTICO (CLI)
+# =========================
+def load_spans(path):
+    spans = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                try:
+                    spans.append(json.loads(line))
+                except ValueError:
+                    continue
+    return spans
+
+def _attach_server_spans(trace, spans):
+    """
+    O servidor MCP corre noutro processo e grava traces próprios: cada raiz
+    "mcp.tool" é ligada à "tool.call" do cliente com o mesmo nome de
+    ferramenta cujo intervalo a contém.
+    """
+    by_trace = {}
+    for s in spans:
+        by_trace.setdefault(s["traceId"], []).append(s)
+    calls = [s for s in trace if s["name"] == "tool.call"]
+    used = set()
+    attached = []
+    for s in spans:
+        if s["name"] != "mcp.tool" or s["parentSpanId"] or s["traceId"] in used:
+            continue
+        for call in calls:
+            if (call["attributes"].get("tool.name") == s["attributes"].get("tool.name")
+                    and call["startTimeUnixNano"] <= s["startTimeUnixNano"]
+                    and s["endTimeUnixNano"] <= call["endTimeUnixNano"]):
+                used.add(s["traceId"])
+                for child in by_trace[s["traceId"]]:
+                    child = dict(child)
+                    if child["spanId"] == s["spanId"]:
+                        child["parentSpanId"] = call["spanId"]
+                    attached.append(child)
+                break
+    return trace + attached
+
+def _critical_children(children):
+    """Filhos no caminho crítico: o que termina por último e, para trás, os que o antecedem"""
+    path = []
+    remaining = sorted(children, key=lambda s: s["endTimeUnixNano"])
+    limit = None
+    while remaining:
+        candidates = [s for s in remaining if limit is None or s["endTimeUnixNano"] <= limit]
+        if not candidates:
+            break
+        last = candidates[-1]
+        path.append(last)
+        limit = last["startTimeUnixNano"]
+        remaining = [s for s in remaining if s["endTimeUnixNano"] <= limit]
+    return path[::-1]
+
+def _duration_ms(s):
+    return (s["endTimeUnixNano"] - s["startTimeUnixNano"]) / 1e6
+
+def _label(s):
+    attrs = s["attributes"]
+    detail = attrs.get("tool.name") or attrs.get("process.command") or attrs.get("llm.iteration")
+    return f"{s['name']} {detail}" if detail is not None else s["name"]
+
+def render(spans, trace_id=None):
+    if not trace_id:
+        roots = [s for s in spans if not s["parentSpanId"] and s["name"] == "agent.turn"]
+        if not roots:
+            roots = [s for s in spans if not s["parentSpanId"]]
+        if not roots:
+            print("Nenhum span encontrado")
+            return
+        trace_id = max(roots, key=lambda s: s["endTimeUnixNano"])["traceId"]
+
+    trace = _attach_server_spans([s for s in spans if s["traceId"] == trace_id], spans)
+    children = {}
+    for s in trace:
+        children.setdefault(s["parentSpanId"], []).append(s)
+    ids = {s["spanId"] for s in trace}
+    roots = [s for s in trace if s["parentSpanId"] not in ids]
+    if not roots:
+        print(f"Trace {trace_id} não encontrado")
+        return
+    root = roots[0]
+    total = _duration_ms(root) or 1.0
+    by_name = {}
+
+    def walk(s, depth, critical):
+        kids = sorted(children.get(s["spanId"], []), key=lambda c: c["startTimeUnixNano"])
+        crit = {c["spanId"] for c in _critical_children(kids)} if critical else set()
+        duration = _duration_ms(s)
+        if critical:
+            # Tempo próprio no caminho crítico (exclui filhos críticos)
+            own = duration - sum(_duration_ms(c) for c in kids if c["spanId"] in crit)
+            by_name[s["name"]] = by_name.get(s["name"], 0.0) + max(own, 0.0)
+        attrs = {k: v for k, v in s["attributes"].items() if k not in ("tool.name", "process.command", "llm.iteration")}
+        extra = " ".join(f"{k}={v}" for k, v in attrs.items())
+        mark = "*" if critical else " "
+        error = " ✗" if s["status"]["code"] == "STATUS_CODE_ERROR" else ""
+        print(f"{mark} {'  ' * depth}{_label(s)[:48]:<{50 - 2 * depth}} {duration:10.1f} ms{error}  {extra[:80]}")
+        for c in kids:
+            walk(c, depth + 1, c["spanId"] in crit)
+
+    print(f"Trace {trace_id} ({root['resource'].get('service.name', '?')})")
+    print("  (* = caminho crítico)\n")
+    walk(root, 0, True)
+    print("\nTempo no caminho crítico por tipo de span:")
+    for name, ms in sorted(by_name.items(), key=lambda kv: -kv[1]):
+        print(f"  {name:<20} {ms:10.1f} ms  {100 * ms / total:5.1f}%")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Uso: python tracing.py trace.jsonl [trace_id]")
+        sys.exit(1)
+    render(load_spans(sys.argv[1]), sys.argv[2] if len(sys.argv) > 2 else None)